@@ -6,6 +6,11 @@ Instructions:
 
  - Ensure that the umqtt/simple.py module is in the /flash/lib directory
    on the XBee Filesystem.
+ - Copy the following files from modules/ to the /flash/lib directory on
+   the XBee Filesystem: gatt_cache.py, ble_helper.py, ble_scan.py,
+   scheduler.py, button.py, telemetry.py, outbox.py, payload.py,
+   mqtt_session.py, backoff.py, deadband.py, nightlight.py,
+   diagnostics.py, memory.py.
  - Name your thing after your IMEI exactly for this example. If your IMEI
    is "0123456789012345" then that should be the name of your thing.
  - The policy attached to the SSL certificates must allow for
@@ -20,12 +25,26 @@ Instructions:
 
 """
 
-from umqtt.simple import MQTTClient
-from time import time, sleep
+from umqtt.simple import MQTTClient, MQTTException
+from mqtt_session import MQTTSession
+from time import sleep, ticks_ms, ticks_diff
 import ujson
 from network import Cellular
 from struct import pack, unpack
 from digi import ble
+from gatt_cache import GATTCache
+from ble_helper import enable_notifications, WriteOnChange
+from ble_scan import BLEScanner
+from nightlight import NightLightDetector
+from scheduler import Scheduler
+from diagnostics import Diagnostics
+from memory import MemoryProfiler
+from button import DebouncedButton
+from outbox import Outbox
+from deadband import DeadbandFilter
+from backoff import Backoff
+from telemetry import TelemetryBatch
+from payload import PayloadBuffer, LIGHT_STATE, NIGHT_LIGHT_STATE
 from machine import Pin
 from sys import print_exception
 
@@ -36,6 +55,38 @@ io_characteristic_uuid = 0x2A56
 env_service_uuid = 0x181a
 lumens_characteristic_uuid = 'c8546913-bfd9-45eb-8dde-9f8754f4a32e'
 
+# Characteristics used by the smart switch: name -> (service, characteristic, index)
+characteristic_specs = {
+    "leds": (io_service_uuid, io_characteristic_uuid, 1),
+    "lumens": (env_service_uuid, lumens_characteristic_uuid, 0),
+}
+
+# Set to True to have the board push lumens readings instead of polling them
+lumens_notify = False
+
+# The night light turns on below the first and off above the second smoothed lumens level,
+# once the level has stayed past the threshold for nightlight_dwell_ms
+nightlight_thresholds = (20, 40)
+nightlight_dwell_ms = 5000
+
+# Task periods in milliseconds, lower means less latency but more power
+periods_ms = {
+    "state": 20,  # button and night light checks
+    "connect": 500,  # BLE connection attempts
+    "ble": 1000,  # BLE sensor reads and LED refresh
+    "publish": 1000,  # cloud publish of pending changes
+    "telemetry": 1000,  # lumens samples batched for the telemetry topic
+    "messages": 200,  # inbound cloud messages
+    "replay": 5000,  # readings queued on flash during an outage
+    "diagnostics": 300000,  # operation counts and latencies published
+}
+
+# Lumens readings within this many counts, or this fraction, of the last one published are
+# only summarized, with a min/max/mean/count summary at the end of each window
+lumens_deadband = 5
+lumens_deadband_ratio = 0.1
+lumens_window_ms = 300000
+
 # AWS endpoint parameters
 host = b'FILL_ME_IN'  # ex: b'a1p3gcs127hy79'
 region = b'FILL_ME_IN'  # ex: b'us-east-2'
@@ -48,7 +99,14 @@ ssl_params = {'keyfile': "cert/aws.key",
               'certfile': "cert/aws.crt",
               'ca_certs': "cert/aws.ca"}  # ssl certs
 
+# Run gc.collect() between tasks once free heap falls below this many bytes, None leaves collections to the
+# allocator, which runs them whenever an allocation fails, possibly in the middle of a publish
+gc_collect_below = None
+
 ble.active(True)
+# times the blocking operations and samples the heap per task, see periods_ms["diagnostics"]
+memory = MemoryProfiler(collect_below=gc_collect_below)
+diagnostics = Diagnostics(size=3072, memory=memory)
 cell_conn = Cellular()
 print("Waiting for network...")
 while not cell_conn.isconnected():
@@ -62,52 +120,61 @@ bulbs = None
 
 
 class BLESmartSwitch:
-    @staticmethod
-    def _find_thunderboard():
-        scanner = ble.gap_scan(200, interval_us=2500, window_us=2500)
-        for adv in scanner:
-            if b"Thunder Sense" in adv['payload']:
-                return adv['address']
-        return None
-
-    def __init__(self):
+    def __init__(self, notify=lumens_notify):
         self.address = None
         self.conn = None
         self.lumens = 100
         self.leds_characteristic = None
         self.lumens_characteristic = None
         self.light_state = [0, 0]
-
-    def get_characteristics_from_uuids(self, service_uuid, characteristic_uuid):
-        services = list(self.conn.gattc_services(service_uuid))
-        if len(services):
-            # Assume that there is only one service per UUID, take the first one
-            my_service = services[0]
-            characteristics = list(self.conn.gattc_characteristics(my_service, characteristic_uuid))
-            return characteristics
-        # Couldn't find specified characteristic, return an empy list
-        return []
+        self.scanner = BLEScanner(name=b"Thunder Sense")
+        self.gatt_cache = GATTCache()
+        # polling is used as a fallback when the board can't notify
+        self.notify = notify
+        self.notifying = False
+        # only writes the LEDs when light_state changes
+        self.leds = WriteOnChange()
+        # smoothed, so noise around a threshold doesn't toggle the night light
+        self.night_light = NightLightDetector(nightlight_thresholds[0], nightlight_thresholds[1], nightlight_dwell_ms)
 
     def is_connected(self):
         return self.conn is not None
 
     def connect(self):
         if self.address is None:
-            self.address = self._find_thunderboard()
+            start = diagnostics.start()
+            self.address = self.scanner.find()
+            diagnostics.record("ble_scan", start)
             if self.address:
                 print("Found thunderboard : {}".format(self.address))
         if self.conn is None:
             if self.address is not None:
                 try:
                     print("Attempting connection to: {}".format(self.address))
+                    start = diagnostics.start()
                     self.conn = ble.gap_connect(ble.ADDR_TYPE_PUBLIC, self.address)
-                    self.leds_characteristic = self.get_characteristics_from_uuids(io_service_uuid,
-                                                                                   io_characteristic_uuid)[1]
-                    self.lumens_characteristic = self.get_characteristics_from_uuids(env_service_uuid,
-                                                                                     lumens_characteristic_uuid)[0]
+                    # skips discovery when the handles for this board are already on flash
+                    characteristics = self.gatt_cache.resolve(self.conn, self.address, characteristic_specs)
+                    self.leds_characteristic = characteristics["leds"]
+                    self.lumens_characteristic = characteristics["lumens"]
+                    self.leds.attach(self.conn, self.leds_characteristic)
+                    self.scanner.remember(self.address)
+                    if self.notify:
+                        self.notifying = enable_notifications(self.conn, self.lumens_characteristic,
+                                                              self._lumens_received)
+                    diagnostics.record("ble_connect", start)
                     print("connected")
                 except OSError:
+                    diagnostics.record("ble_connect_failed", start)
                     self.conn = None
+                    self.notifying = False
+                    # an address remembered from a previous boot may be stale, scan next time
+                    if self.scanner.directed:
+                        self.address = None
+
+    def _lumens_received(self, data):
+        self.lumens = int(unpack('<I', data)[0]/100)
+        self.night_light.add(self.lumens)
 
     def get_lumens(self):
         return self.lumens
@@ -122,22 +189,35 @@ class BLESmartSwitch:
         self.light_state[0] = value
 
     def update_nightlight(self):
-        prev_light_state = self.light_state[1]
-        if self.lumens < 20:
-            self.light_state[1] = True
-        if self.lumens > 40:
-            self.light_state[1] = False
-        return prev_light_state != self.light_state[1]
+        if self.night_light.update():
+            self.light_state[1] = self.night_light.state
+            return True
+        return False
+
+    def sync_leds(self):
+        if self.conn is not None:
+            try:
+                self.leds.set(pack("b", self.light_state[0] | (self.light_state[1] << 2)))
+                writes = self.leds.writes
+                start = diagnostics.start()
+                self.leds.sync()
+                if self.leds.writes != writes:
+                    diagnostics.record("led_write", start)
+            except OSError:
+                self.conn = None
+                self.notifying = False
 
     def update(self):
+        self.sync_leds()
         if self.conn is not None:
             try:
-                led_value = pack("b", self.light_state[0] | (self.light_state[1] << 2))
-                self.conn.gattc_write_characteristic(self.leds_characteristic, led_value)
-                self.lumens = self.conn.gattc_read_characteristic(self.lumens_characteristic)
-                self.lumens = int(unpack('<I', self.lumens)[0]/100)
+                if not self.notifying:
+                    start = diagnostics.start()
+                    self._lumens_received(self.conn.gattc_read_characteristic(self.lumens_characteristic))
+                    diagnostics.record("gatt_read", start)
             except OSError:
                 self.conn = None
+                self.notifying = False
 
 
 def check_cellular():
@@ -160,27 +240,89 @@ def delta_callback(topic, msg):
 
 
 class AWSShadow:
-    def __init__(self, client_id=imei, hostname=aws_endpoint, sslp=ssl_params):
+    # shadow field names and their payload templates
+    _fields = (("light_state", LIGHT_STATE), ("night_light_state", NIGHT_LIGHT_STATE))
+
+    def __init__(self, client_id=imei, hostname=aws_endpoint, sslp=ssl_params, accept_timeout_ms=10000,
+                 callback=delta_callback):
         self.client = MQTTClient(client_id, hostname, ssl=True, ssl_params=sslp)
-        self.client.set_callback(delta_callback)
+        self.client.set_callback(self._shadow_callback)
+        # a persistent session keeps the subscriptions and the deltas sent while we're offline
+        self.session = MQTTSession(self.client, diagnostics=diagnostics)
+        self.callback = callback
         self.shadowpath = "$aws/things/{}/shadow/".format(imei)
+        # topics and the payload buffer are made once so publishing doesn't allocate
+        self.update_topic = (self.shadowpath + "update").encode()
+        self.accepted_topic = (self.shadowpath + "update/accepted").encode()
+        self.rejected_topic = (self.shadowpath + "update/rejected").encode()
+        self.telemetry_topic = "smartswitch/{}/lumens/".format(imei).encode()
+        self.summary_topic = "smartswitch/{}/lumens/summary".format(imei).encode()
+        self.diagnostics_topic = "smartswitch/{}/diagnostics".format(imei).encode()
+        self.payload = PayloadBuffer()
+        for topic in ("update/delta", "update/accepted", "update/rejected"):
+            self.session.subscribe(self.shadowpath + topic)
         print(self.shadowpath)
         self.connected = False
+        # lumens samples waiting for the telemetry topic
+        self.telemetry = TelemetryBatch()
+        # reported state the shadow has acknowledged, the state we want it to have and its version
+        self.reported = {}
+        self.wanted = {"light_state": None, "night_light_state": None}
+        # fields published but not yet accepted, dropped if the shadow doesn't answer within accept_timeout_ms
+        self.sent = {}
+        self.sent_at = None
+        self.accept_timeout_ms = accept_timeout_ms
+        self.version = None
+        self.retry = False
+        # spaces out connection attempts while AWS can't be reached
+        self.backoff = Backoff()
 
     def is_connected(self):
         return self.connected
 
     def connect(self):
+        if not self.backoff.ready(check_cellular()):
+            return
         try:
             print("trying MQTT")
-            self.client.connect()
+            if self.session.connect():
+                print("resumed MQTT session, {} messages sent again".format(self.session.pending()))
+            else:
+                print("subscribed to {}".format(", ".join(topic for topic, qos in self.session.subscriptions)))
             self.connected = True
-            self.client.subscribe(self.shadowpath + "update/delta")
-            print("subscribed to {}".format(self.shadowpath + "update/delta"))
+            # the shadow may have changed while we were away, report everything again
+            self.reported = {}
+            self.sent = {}
+            self.backoff.succeeded()
             print("connected to MQTT")
-        except OSError as e:
+        except (OSError, MQTTException) as e:
             print_exception(e)
             self.connected = False
+            self.backoff.failed()
+
+    def _shadow_callback(self, topic, msg):
+        if topic == self.accepted_topic:
+            doc = ujson.loads(msg.decode('utf-8'))
+            version = doc.get("version", 0)
+            if self.version is not None and version < self.version:
+                # an older update arriving late
+                return
+            self.version = version
+            for key, value in doc.get("state", {}).get("reported", {}).items():
+                self.reported[key] = value
+                if self.sent.get(key) == value:
+                    del self.sent[key]
+            print("shadow version {} accepted".format(self.version))
+        elif topic == self.rejected_topic:
+            doc = ujson.loads(msg.decode('utf-8'))
+            code = doc.get("code", 0)
+            print("shadow update rejected: {} {}".format(code, doc.get("message")))
+            # diff the next update against what the shadow has acknowledged
+            self.sent = {}
+            # a malformed or unauthorized update won't succeed if sent again
+            self.retry = code == 429 or code >= 500
+        elif self.callback is not None:
+            self.callback(topic, msg)
 
     @staticmethod
     def _get_on_off(value):
@@ -189,60 +331,196 @@ class AWSShadow:
         else:
             return 'off'
 
+    def sample(self, lumens):
+        self.telemetry.add(lumens)
+        if self.telemetry.due():
+            self.flush_telemetry()
+
+    def publish_summary(self, readings):
+        """
+        Publish the window summary of a DeadbandFilter.
+        :return: True if it was published.
+        """
+        if not self.connected:
+            return False
+        try:
+            if not self.session.publish(self.summary_topic, readings.write(self.payload.reset()).payload()):
+                return False
+            print("published summary of", readings.stats[3], "lumens readings")
+            return True
+        except OSError:
+            self.connected = False
+            return False
+
+    def publish_diagnostics(self, report):
+        """
+        Publish a Diagnostics snapshot.
+        :return: True if it was published.
+        """
+        if not self.connected:
+            return False
+        try:
+            return self.session.publish(self.diagnostics_topic, report.payload())
+        except OSError:
+            self.connected = False
+            return False
+
+    def flush_telemetry(self):
+        if self.telemetry.count == 0:
+            return True
+        if not self.connected:
+            return False
+        try:
+            if not self.session.publish(self.telemetry_topic, self.telemetry.payload()):
+                # too many messages waiting for the broker, keep the batch
+                return False
+            print("updated telemetry with", self.telemetry.count, "samples")
+            self.telemetry.clear()
+            return True
+        except OSError:
+            self.connected = False
+            return False
+
     def update(self, light, nightlight, lumens):
+        """
+        Send a changed state: the batched samples with this reading, then the shadow update.
+        :return: False if the reading wasn't sent and should be kept in the outbox.
+        """
+        # a state change sends the batched samples right away
+        if not self.telemetry.add(lumens):
+            # full, make room first
+            if not self.flush_telemetry():
+                return False
+            self.telemetry.add(lumens)
+        if not self.flush_telemetry():
+            # the reading goes to the outbox instead, don't send it twice
+            self.telemetry.pop()
+            return False
+        if not self._report(light, nightlight):
+            # the reading is out, the state stays in wanted and check() sends it
+            self.retry = True
+        return True
+
+    def _report(self, light, nightlight):
+        self.wanted["light_state"] = self._get_on_off(light)
+        self.wanted["night_light_state"] = self._get_on_off(nightlight)
+        return self._update_shadow()
+
+    def replay(self, outbox):
+        """
+        Publish readings queued in the outbox as one telemetry batch, with the times they were captured
+        at, and report only the newest state to the shadow. The records stay queued unless both go out.
+        :return: Number of records sent.
+        """
+        # samples batched before the outage go first, the batch then only holds queued readings
+        if not self.flush_telemetry():
+            return 0
+        latest = []
+
+        def add(timestamp, light, nightlight, lumens):
+            if not self.telemetry.add(lumens, timestamp):
+                return False
+            latest[:] = (light, nightlight)
+            return True
+
+        sent = outbox.replay(add, len(self.telemetry.values), defer=True)
+        if not sent:
+            return 0
+        if not self._report(latest[0], latest[1]) or not self.flush_telemetry():
+            # the shadow diff keeps a state already sent from going again
+            self.telemetry.clear()
+            outbox.rewind()
+            return 0
+        outbox.acknowledge(outbox.cursor)
+        print("replayed", sent, "queued readings")
+        return sent
+
+    def _update_shadow(self):
+        # only send the fields that differ from the last update sent, or the shadow if none is in flight
+        self.payload.reset().write(b'{"state":{"reported":{')
+        first = True
+        for key, template in self._fields:
+            value = self.wanted[key]
+            if value is not None and self.sent.get(key, self.reported.get(key)) != value:
+                self.payload.field_on_off(template, value == 'on', first)
+                first = False
+        if first:
+            print("shadow already up to date")
+            return True
+        self.payload.write(b'},"desired":null}}')
         try:
             print("updating shadow")
-            telemetry = {"lumens": lumens}
-            state = {"state": {"reported": {"light_state": self._get_on_off(light),
-                                            "night_light_state": self._get_on_off(nightlight)}, "desired": None}}
-            telemetry_path = "smartswitch/{}/lumens/".format(imei)
-            shadow_path = "$aws/things/{}/shadow/".format(imei)
-            print(shadow_path)
-            self.client.publish(telemetry_path, ujson.dumps(telemetry))
-            print("updated {}".format(telemetry_path))
-            self.client.publish(shadow_path + "update", ujson.dumps(state))
-            print("updated {}".format(shadow_path))
+            if not self.session.publish(self.update_topic, self.payload.payload()):
+                return False
+            for key, template in self._fields:
+                value = self.wanted[key]
+                if value is not None and self.sent.get(key, self.reported.get(key)) != value:
+                    self.sent[key] = value
+            self.sent_at = ticks_ms()
+            print("updated shadow")
             return True
         except OSError:
             self.connected = False
 
+    def _check_accepted(self):
+        if self.sent and ticks_diff(ticks_ms(), self.sent_at) >= self.accept_timeout_ms:
+            print("shadow update not accepted, sending it again")
+            self.sent = {}
+            self.retry = True
+
     def check(self):
-        self.client.check_msg()
+        self.session.check_msg()
+        self._check_accepted()
+        if self.retry:
+            self.retry = False
+            self._update_shadow()
 
 
 def update_cloud(aws_client):
     global bulbs
     print("update cloud")
-    if check_cellular():
+    # anything still queued goes first so the cloud sees the changes in order
+    if not outbox.pending() and check_cellular():
         if not aws_client.is_connected():
             aws_client.connect()
         if aws_client.is_connected():
-            aws_client.update(bulbs.get_light(), bulbs.get_night_light(), bulbs.get_lumens())
-            return True
-    return False
+            if aws_client.update(bulbs.get_light(), bulbs.get_night_light(), bulbs.get_lumens()):
+                return True
+    # keep the reading on flash until it can be sent
+    outbox.append(bulbs.get_light(), bulbs.get_night_light(), bulbs.get_lumens())
+    return True
+
+
+def replay_outbox(client):
+    # rate limited by the replay period and batch size so a backlog doesn't flood the link
+    if outbox.pending() and check_cellular():
+        if not client.is_connected():
+            client.connect()
+        if client.is_connected():
+            client.replay(outbox)
 
 
 class Button:
     global bulbs
 
     def __init__(self):
-        self.button = Pin.board.D1
-        self.button.mode(Pin.IN)
-        self.button.pull(Pin.PULL_UP)
-        self.state = [1, 1]
+        self.button = DebouncedButton(Pin.board.D1)
 
     def check_button(self):
-        # set the previous state
-        self.state[0] = self.state[1]
-        # read the current button state
-        self.state[1] = self.button.value()
-        # detected button release
-        if self.state == [0, 1]:
-            print('button press detected:', self.state, bulbs.get_light(), bulbs.get_night_light())
-            print(self.state, bulbs.get_light(), bulbs.get_night_light())
+        pressed = False
+        # each queued release toggles the light, none are lost while the loop was busy
+        released_at = self.button.get()
+        while released_at is not None:
+            # how long the release waited for the loop to get to it
+            diagnostics.record_since_ms("button", released_at)
+            print('button press detected:', bulbs.get_light(), bulbs.get_night_light())
             bulbs.set_light(not bulbs.get_light())
-            return True
-        return False
+            pressed = True
+            released_at = self.button.get()
+        if pressed:
+            # write the LEDs now rather than at the next refresh
+            bulbs.sync_leds()
+        return pressed
 
 
 def __main():
@@ -250,41 +528,63 @@ def __main():
     button = Button()
     aws_client = AWSShadow()
     aws_client.connect()
-    lasttime = time()
+
+    def check_state():
+        global update_state
+        if button.check_button():
+            update_state = UPDATE_CLOUD
+        if bulbs.update_nightlight():
+            update_state = UPDATE_CLOUD
+
+    def publish():
+        global update_state
+        # Update the cloud if an update is needed
+        if update_state == UPDATE_CLOUD:
+            if update_cloud(aws_client):
+                update_state = UPDATE_NONE
+
+    def check_messages():
+        if check_cellular():
+            if aws_client.is_connected():
+                # check for shadow updates via callback
+                aws_client.check()
+            else:
+                aws_client.connect()
+
+    def sample_telemetry():
+        if bulbs.is_connected():
+            lumens = bulbs.get_lumens()
+            # readings inside the deadband only count towards the window summary
+            if lumens_filter.add(lumens):
+                aws_client.sample(lumens)
+            elif aws_client.telemetry.due():
+                aws_client.flush_telemetry()
+            if lumens_filter.due() and aws_client.publish_summary(lumens_filter):
+                lumens_filter.clear()
+
+    lumens_filter = DeadbandFilter(absolute=lumens_deadband, relative=lumens_deadband_ratio,
+                                   window_ms=lumens_window_ms)
+
+    def publish_diagnostics():
+        aws_client.publish_diagnostics(diagnostics)
+        # start again even if it wasn't published, so the totals can't overflow while we're offline
+        diagnostics.clear()
+
+    scheduler = Scheduler(diagnostics, memory)
+    scheduler.add(check_state, periods_ms["state"], name="state")
+    scheduler.add(bulbs.connect, periods_ms["connect"], name="connect")
+    # Refresh the state of the sensors readings
+    scheduler.add(bulbs.update, periods_ms["ble"], periods_ms["ble"] // 2, name="ble")
+    scheduler.add(publish, periods_ms["publish"], name="publish")
+    scheduler.add(lambda: replay_outbox(aws_client), periods_ms["replay"], name="replay")
+    scheduler.add(sample_telemetry, periods_ms["telemetry"], name="telemetry")
+    scheduler.add(check_messages, periods_ms["messages"], name="messages")
+    scheduler.add(publish_diagnostics, periods_ms["diagnostics"], name="diagnostics")
     print("Entering loop")
-    while True:
-        try:
-            if not bulbs.is_connected():
-                bulbs.connect()
-            if button.check_button():
-                update_state = UPDATE_CLOUD
-            if bulbs.update_nightlight():
-                update_state = UPDATE_CLOUD
-
-            # Wait until at least 1 second has elapsed before updating
-            if time() - lasttime > 1:
-                lasttime = time()
-                # Update the light and cloud if an update is needed
-                if bulbs.is_connected():
-                    # Refresh the state of the sensors readings
-                    bulbs.update()
-
-                # Refresh the state of the sensors readings
-                if update_state == UPDATE_CLOUD:
-                    if update_cloud(aws_client):
-                        update_state = UPDATE_NONE
-            if check_cellular():
-                if aws_client.is_connected():
-                    # check for shadow updates via callback
-                    aws_client.check()
-                else:
-                    aws_client.connect()
-
-        except OSError as e:
-            # provide debug info, but keep going
-            print_exception(e)
+    scheduler.run()
 
 
 bulbs = BLESmartSwitch()
+outbox = Outbox()
 update_state = UPDATE_NONE
 __main()
@@ -6,6 +6,11 @@ Instructions:
 
  - Ensure that the umqtt/simple.py and urllib/parse.py modules are in
    the /flash/lib directory on the XBee Filesystem
+ - Copy the following files from modules/ to the /flash/lib directory on
+   the XBee Filesystem: gatt_cache.py, ble_helper.py, ble_scan.py,
+   scheduler.py, button.py, outbox.py, payload.py, hmac_sha256.py,
+   mqtt_session.py, backoff.py, deadband.py, nightlight.py,
+   diagnostics.py, memory.py, telemetry.py.
  - Create an account on the Microsoft Azure plaform, note that
    if you have a corporate account you will need to get permission from your
    administrator or may create your own account.
@@ -30,14 +35,28 @@ Instructions:
 
 """
 
-from hashlib import sha256
 from umqtt.simple import MQTTClient, MQTTException
+from mqtt_session import MQTTSession
 import ujson
 from time import time, sleep
 from ubinascii import a2b_base64 as b64decode, b2a_base64 as b64encode
 from network import Cellular
 from struct import pack, unpack
 from digi import ble
+from gatt_cache import GATTCache
+from ble_helper import enable_notifications, WriteOnChange
+from ble_scan import BLEScanner
+from nightlight import NightLightDetector
+from scheduler import Scheduler
+from diagnostics import Diagnostics
+from memory import MemoryProfiler
+from button import DebouncedButton
+from outbox import Outbox
+from deadband import DeadbandFilter
+from backoff import Backoff
+from telemetry import TelemetryBatch
+from hmac_sha256 import hmac_digest
+from payload import PayloadBuffer, LIGHT_STATE, NIGHT_LIGHT_STATE, LUMENS
 from machine import Pin
 from urllib.parse import quote_plus, urlencode
 from sys import print_exception
@@ -49,6 +68,39 @@ io_characteristic_uuid = 0x2A56
 env_service_uuid = 0x181a
 lumens_characteristic_uuid = 'c8546913-bfd9-45eb-8dde-9f8754f4a32e'
 
+# Characteristics used by the smart switch: name -> (service, characteristic, index)
+characteristic_specs = {
+    "leds": (io_service_uuid, io_characteristic_uuid, 1),
+    "lumens": (env_service_uuid, lumens_characteristic_uuid, 0),
+}
+
+# Set to True to have the board push lumens readings instead of polling them
+lumens_notify = False
+
+# The night light turns on below the first and off above the second smoothed lumens level,
+# once the level has stayed past the threshold for nightlight_dwell_ms
+nightlight_thresholds = (20, 40)
+nightlight_dwell_ms = 5000
+
+# Task periods in milliseconds, lower means less latency but more power
+periods_ms = {
+    "state": 20,  # button and night light checks
+    "connect": 500,  # BLE connection attempts
+    "ble": 1000,  # BLE sensor reads and LED refresh
+    "publish": 1000,  # cloud publish of pending changes
+    "messages": 200,  # inbound cloud messages
+    "replay": 5000,  # readings queued on flash during an outage
+    "token": 60000,  # SAS token renewal check
+    "telemetry": 1000,  # lumens readings, batched when they change enough
+    "diagnostics": 300000,  # operation counts and latencies published
+}
+
+# Lumens readings within this many counts, or this fraction, of the last one published are
+# only summarized, with a min/max/mean/count summary at the end of each window
+lumens_deadband = 5
+lumens_deadband_ratio = 0.1
+lumens_window_ms = 300000
+
 # Azure connection parameters
 IoTHubConnectionString = "FILL_ME_IN"
 IoTDeviceId = "FILL_ME_IN"
@@ -56,7 +108,14 @@ if IoTHubConnectionString == "FILL_ME_IN":
     print("Connection parameters not set. You must fill them in.")
     exit(-1)
 
+# Run gc.collect() between tasks once free heap falls below this many bytes, None leaves collections to the
+# allocator, which runs them whenever an allocation fails, possibly in the middle of a publish
+gc_collect_below = None
+
 ble.active(True)
+# times the blocking operations and samples the heap per task, see periods_ms["diagnostics"]
+memory = MemoryProfiler(collect_below=gc_collect_below)
+diagnostics = Diagnostics(size=3072, memory=memory)
 cell_conn = Cellular()
 
 UPDATE_NONE, UPDATE_CLOUD = 0, 1
@@ -81,38 +140,61 @@ def _default_call_back(topic, msg):
 
 
 class AzureMQTT:
-    def __init__(self, connection_string: str, policy_name=None, expiry: int = 36000):
+    def __init__(self, connection_string: str, policy_name=None, expiry: int = 36000, renew_margin: int = 600):
         self.params = dict(field.split('=', 1) for field in connection_string.split(';'))
         required_keys = ["HostName", "DeviceId", "SharedAccessKey"]
         if any(k not in self.params for k in required_keys):
             raise ValueError("connection_string is invalid, should be in the following format:",
                              "HostName=foo.bar;DeviceId=Fo0B4r;SharedAccessKey=Base64FooBar")
-        self.sas_token = generate_sas_token(self.params["HostName"], self.params["SharedAccessKey"],
-                                            policy_name=policy_name, expiry=expiry)
+        self.policy_name = policy_name
+        self.expiry = expiry
+        # renew the token this many seconds before it expires, so the reconnect happens when we choose
+        self.renew_margin = min(renew_margin, expiry // 2)
         self.username = "{host_name}/{device_id}/?api-version=2018-06-30".format(host_name=self.params["HostName"],
                                                                                  device_id=self.params["DeviceId"])
-        self.password = self.sas_token
 
         self.mqtt_client = MQTTClient(client_id=self.params["DeviceId"], server=self.params["HostName"],
-                                      user=self.username, password=self.password, ssl=True)
+                                      user=self.username, password=None, ssl=True)
+        # a persistent session keeps the subscriptions and the messages sent while we're offline
+        self.session = MQTTSession(self.mqtt_client, diagnostics=diagnostics)
+        self.renew_token()
         self._default_subscribe_string = "default"
         self._subscription_list = ["devices/{device_id}/messages/devicebound/#".format(device_id=self.params["DeviceId"])]
 
+    def renew_token(self):
+        """
+        Generate a new SAS token and hand it to the MQTT client, it is used from the next connect on.
+        """
+        now = time()
+        self.sas_token = generate_sas_token(self.params["HostName"], self.params["SharedAccessKey"],
+                                            policy_name=self.policy_name, expiry=self.expiry)
+        self.password = self.sas_token
+        self.mqtt_client.pswd = self.password
+        self.token_expires = now + self.expiry
+
+    def token_due(self) -> bool:
+        """
+        :return: True once the SAS token is within renew_margin seconds of expiring, or already has.
+        """
+        # also true after the clock was set from the network, when the token was made with the wrong time
+        return time() >= self.token_expires - self.renew_margin
+
     def _default_subscribe(self):
         for s in self._subscription_list:
             print("subscribing to: ", s)
-            self.mqtt_client.subscribe(s)
+            self.session.subscribe(s)
 
     def setup(self, callback=_default_call_back, subscribe_string: str = "default"):
         """
         An easy way to connect, set the callback, and subscribe to messages.
         :return:
         """
-        self._connect()
+        # a resumed session delivers what was queued for us straight after connecting
         self.mqtt_client.set_callback(callback)
         self._default_subscribe()
         if subscribe_string != "default":
-            self.mqtt_client.subscribe(subscribe_string)
+            self.session.subscribe(subscribe_string)
+        self._connect()
 
     def _connect(self):
         """
@@ -121,7 +203,7 @@ class AzureMQTT:
         :return:
         """
         try:
-            self.mqtt_client.connect()
+            self.session.connect()
         except MQTTException as e:
             print_exception(e)
             error_num = int(e.args[0])
@@ -139,23 +221,46 @@ class AzureMQTT:
                 raise MQTTException(str(error_num) + ":",
                                     "The server reported an error not specified in the MQTT spec as of v3.1.1")
 
-    def send(self, prop: dict, payload: str):
+    def disconnect(self):
+        try:
+            self.mqtt_client.disconnect()
+        except OSError:
+            # the socket is being thrown away anyway
+            pass
+
+    def events_topic(self, prop: dict) -> bytes:
+        """
+        Build the device-to-cloud topic for a message property once, so it can be reused with publish().
+        :param prop: Message property for route filtering, e.g. {"name": "level", "value": "storage"}.
+        :return: The topic.
+        """
         properties = "%s=%s" % (prop['name'], prop['value'])
-        topic_string = "devices/{device_id}/messages/events/{p}".format(device_id=self.params["DeviceId"], p=properties)
-        print(topic_string)
-        self.mqtt_client.publish(topic=topic_string, msg=payload)
+        return "devices/{device_id}/messages/events/{p}".format(device_id=self.params["DeviceId"], p=properties).encode()
+
+    def send(self, prop: dict, payload: str):
+        topic = self.events_topic(prop)
+        print(topic)
+        return self.publish(topic, payload)
+
+    def publish(self, topic: bytes, payload) -> bool:
+        """
+        Publish at QoS 1 without waiting for the hub.
+        :return: True once the message is on its way, False if too many are waiting for the hub.
+        """
+        return self.session.publish(topic, payload)
 
     def wait_msg(self):
-        self.mqtt_client.wait_msg()
+        self.session.wait_msg()
 
     def check_msg(self):
-        self.mqtt_client.check_msg()
+        self.session.check_msg()
 
     def print(self):
         print("Host Name:        ", self.params["HostName"])
         print("Device ID:        ", self.params["DeviceId"])
         print("Shared Access Key:", self.params["SharedAccessKey"])
         print("SAS Token:        ", self.sas_token)
+        print("Token Expires:    ", self.token_expires)
         print("Username:         ", self.username)
         print("Password:         ", self.password)
 
@@ -185,91 +290,62 @@ def generate_sas_token(uri: str, key: str, policy_name=None, expiry: int = 36000
     return 'SharedAccessSignature ' + urlencode(rawtoken)
 
 
-def hmac_digest(key: bytes, message: bytes) -> bytes:
-    """
-    A MicroPython implementation of HMAC.digest(), because HMAC isn't accessible yet.
-    :param key: key for the keyed hash object.
-    :param message: input for the digest.
-    :return: digest of the message passed in.
-    """
-    trans_5C = bytes((x ^ 0x5C) for x in range(256))
-    trans_36 = bytes((x ^ 0x36) for x in range(256))
-    inner = sha256()
-    outer = sha256()
-    blocksize = 64
-    if len(key) > blocksize:
-        key = sha256(key).digest()
-    key = key + b'\x00' * (blocksize - len(key))
-    inner.update(bytes_translate(key, trans_36))
-    outer.update(bytes_translate(key, trans_5C))
-    inner.update(message)
-    outer.update(inner.digest())
-    return outer.digest()
-
-
-def bytes_translate(input_bytes: bytes, input_table: bytes):
-    """
-    A MicroPython implementation of bytes.translate, because that doesn't actually exist at minimum on the XBee.
-    Essentially bytes.translate without using bytes.translate.
-    :param input_bytes: Bytes to be run through the table.
-    :param input_table: 256 byte table.
-    :return: Input_Bytes, but run through the table.
-    """
-    if len(input_table) != 256:
-        raise ValueError("Input table must be 256 bytes long.")
-    output_bytes = []
-    for byte in input_bytes:
-        output_bytes.append(input_table[int(byte)])
-    return bytes(output_bytes)
-
-
 class BLESmartSwitch:
-    @staticmethod
-    def _find_thunderboard():
-        scanner = ble.gap_scan(200, interval_us=2500, window_us=2500)
-        for adv in scanner:
-            if b"Thunder Sense" in adv['payload']:
-                return adv['address']
-        return None
-
-    def __init__(self):
+    def __init__(self, notify=lumens_notify):
         self.address = None
         self.conn = None
         self.lumens = 100
         self.leds_characteristic = None
         self.lumens_characteristic = None
         self.light_state = [0, 0]
-
-    def get_characteristics_from_uuids(self, service_uuid, characteristic_uuid):
-        services = list(self.conn.gattc_services(service_uuid))
-        if len(services):
-            # Assume that there is only one service per UUID, take the first one
-            my_service = services[0]
-            characteristics = list(self.conn.gattc_characteristics(my_service, characteristic_uuid))
-            return characteristics
-        # Couldn't find specified characteristic, return an empy list
-        return []
+        self.scanner = BLEScanner(name=b"Thunder Sense")
+        self.gatt_cache = GATTCache()
+        # polling is used as a fallback when the board can't notify
+        self.notify = notify
+        self.notifying = False
+        # only writes the LEDs when light_state changes
+        self.leds = WriteOnChange()
+        # smoothed, so noise around a threshold doesn't toggle the night light
+        self.night_light = NightLightDetector(nightlight_thresholds[0], nightlight_thresholds[1], nightlight_dwell_ms)
 
     def is_connected(self):
         return self.conn is not None
 
     def connect(self):
         if self.address is None:
-            self.address = self._find_thunderboard()
+            start = diagnostics.start()
+            self.address = self.scanner.find()
+            diagnostics.record("ble_scan", start)
             if self.address:
                 print("Found thunderboard : {}".format(self.address))
         if self.conn is None:
             if self.address is not None:
                 try:
                     print("Attempting connection to: {}".format(self.address))
+                    start = diagnostics.start()
                     self.conn = ble.gap_connect(ble.ADDR_TYPE_PUBLIC, self.address)
-                    self.leds_characteristic = self.get_characteristics_from_uuids(io_service_uuid,
-                                                                                   io_characteristic_uuid)[1]
-                    self.lumens_characteristic = self.get_characteristics_from_uuids(env_service_uuid,
-                                                                                     lumens_characteristic_uuid)[0]
+                    # skips discovery when the handles for this board are already on flash
+                    characteristics = self.gatt_cache.resolve(self.conn, self.address, characteristic_specs)
+                    self.leds_characteristic = characteristics["leds"]
+                    self.lumens_characteristic = characteristics["lumens"]
+                    self.leds.attach(self.conn, self.leds_characteristic)
+                    self.scanner.remember(self.address)
+                    if self.notify:
+                        self.notifying = enable_notifications(self.conn, self.lumens_characteristic,
+                                                              self._lumens_received)
+                    diagnostics.record("ble_connect", start)
                     print("connected")
                 except OSError:
+                    diagnostics.record("ble_connect_failed", start)
                     self.conn = None
+                    self.notifying = False
+                    # an address remembered from a previous boot may be stale, scan next time
+                    if self.scanner.directed:
+                        self.address = None
+
+    def _lumens_received(self, data):
+        self.lumens = int(unpack('<I', data)[0]/100)
+        self.night_light.add(self.lumens)
 
     def get_lumens(self):
         return self.lumens
@@ -284,22 +360,35 @@ class BLESmartSwitch:
         self.light_state[0] = value
 
     def update_nightlight(self):
-        prev_light_state = self.light_state[1]
-        if self.lumens < 20:
-            self.light_state[1] = True
-        if self.lumens > 40:
-            self.light_state[1] = False
-        return prev_light_state != self.light_state[1]
+        if self.night_light.update():
+            self.light_state[1] = self.night_light.state
+            return True
+        return False
+
+    def sync_leds(self):
+        if self.conn is not None:
+            try:
+                self.leds.set(pack("b", self.light_state[0] | (self.light_state[1] << 2)))
+                writes = self.leds.writes
+                start = diagnostics.start()
+                self.leds.sync()
+                if self.leds.writes != writes:
+                    diagnostics.record("led_write", start)
+            except OSError:
+                self.conn = None
+                self.notifying = False
 
     def update(self):
+        self.sync_leds()
         if self.conn is not None:
             try:
-                led_value = pack("b", self.light_state[0] | (self.light_state[1] << 2))
-                self.conn.gattc_write_characteristic(self.leds_characteristic, led_value)
-                self.lumens = self.conn.gattc_read_characteristic(self.lumens_characteristic)
-                self.lumens = int(unpack('<I', self.lumens)[0]/100)
+                if not self.notifying:
+                    start = diagnostics.start()
+                    self._lumens_received(self.conn.gattc_read_characteristic(self.lumens_characteristic))
+                    diagnostics.record("gatt_read", start)
             except OSError:
                 self.conn = None
+                self.notifying = False
 
 
 def check_cellular():
@@ -311,20 +400,36 @@ class AzureCloud:
         self.client = AzureMQTT(connectionstring)
         self.connected = False
         self.iotdeviceid = deviceid
+        # property for route filtering, the topic and payload buffer are made once so publishing doesn't allocate
+        self.telemetry_topic = self.client.events_topic({"name": "level", "value": "storage"})
+        self.diagnostics_topic = self.client.events_topic({"name": "level", "value": "diagnostics"})
+        self.payload = PayloadBuffer()
+        # lumens readings outside the deadband, published together
+        self.telemetry = TelemetryBatch()
+        # spaces out connection attempts while the hub can't be reached
+        self.backoff = Backoff()
 
     def is_connected(self):
         return self.connected
 
     def connect(self):
+        if not self.backoff.ready(check_cellular()):
+            return
         try:
+            # a token that lapsed while we were offline would only be refused
+            if self.client.token_due():
+                self.client.renew_token()
             print("calling setup")
             self.client.setup()
             print("called setup")
             self.connected = True
+            self.backoff.succeeded()
             print("connected to MQTT")
-        except OSError as e:
+        except (OSError, MQTTException) as e:
+            # MQTTException is the hub refusing us, e.g. a bad SAS token, retrying at once won't help either
             print_exception(e)
             self.connected = False
+            self.backoff.failed()
 
     @staticmethod
     def _get_on_off(value):
@@ -333,21 +438,110 @@ class AzureCloud:
         else:
             return 'off'
 
+    def _encode(self, light, nightlight, lumens):
+        self.payload.reset().write(b'{')
+        self.payload.field_on_off(LIGHT_STATE, light, True).field_on_off(NIGHT_LIGHT_STATE, nightlight)
+        return self.payload.field_int(LUMENS, lumens).write(b'}').payload()
+
     def update(self, light, nightlight, lumens):
         try:
             print("updating IoT Device")
-            state = {"light_state": self._get_on_off(light),
-                     "night_light_state": self._get_on_off(nightlight),
-                     "lumens": lumens}
-            # property for route filtering
-            prop = {"name":"level", "value":"storage"}
-
-            self.client.send(prop, ujson.dumps(state))
-            print("updated {}".format(ujson.dumps(state)))
+            if not self.client.publish(self.telemetry_topic, self._encode(light, nightlight, lumens)):
+                return False
+            print("updated IoT Device")
             return True
         except OSError:
             self.connected = False
 
+    def replay(self, outbox):
+        """
+        Publish readings queued in the outbox as one telemetry batch, with the times they were captured
+        at, and report only the newest state. The records stay queued unless both go out.
+        :return: Number of records sent.
+        """
+        # samples batched before the outage go first, the batch then only holds queued readings
+        if not self.flush_telemetry():
+            return 0
+        latest = []
+
+        def add(timestamp, light, nightlight, lumens):
+            if not self.telemetry.add(lumens, timestamp):
+                return False
+            latest[:] = (light, nightlight, lumens)
+            return True
+
+        sent = outbox.replay(add, len(self.telemetry.values), defer=True)
+        if not sent:
+            return 0
+        # the newest state goes out as the usual state message, the batch has the readings' times
+        if not self.update(latest[0], latest[1], latest[2]) or not self.flush_telemetry():
+            self.telemetry.clear()
+            outbox.rewind()
+            return 0
+        outbox.acknowledge(outbox.cursor)
+        print("replayed", sent, "queued readings")
+        return sent
+
+
+    def sample(self, lumens):
+        self.telemetry.add(lumens)
+        if self.telemetry.due():
+            self.flush_telemetry()
+
+    def flush_telemetry(self):
+        if self.telemetry.count == 0:
+            return True
+        if not self.connected:
+            return False
+        try:
+            if not self.client.publish(self.telemetry_topic, self.telemetry.payload()):
+                # too many messages waiting for the hub, keep the batch
+                return False
+            print("updated telemetry with", self.telemetry.count, "samples")
+            self.telemetry.clear()
+            return True
+        except OSError:
+            self.connected = False
+            return False
+
+    def publish_summary(self, readings):
+        """
+        Publish the window summary of a DeadbandFilter as telemetry.
+        :return: True if it was published.
+        """
+        try:
+            summary = readings.write(self.payload.reset()).payload()
+            if self.connected and self.client.publish(self.telemetry_topic, summary):
+                print("published summary of", readings.stats[3], "lumens readings")
+                return True
+        except OSError:
+            self.connected = False
+        return False
+
+    def publish_diagnostics(self, report):
+        """
+        Publish a Diagnostics snapshot as telemetry.
+        :return: True if it was published.
+        """
+        try:
+            return self.connected and self.client.publish(self.diagnostics_topic, report.payload())
+        except OSError:
+            self.connected = False
+            return False
+
+    def check_token(self):
+        """
+        Reconnect with a new SAS token before the current one expires, rather than waiting
+        for the hub to drop the connection and refusing every reconnect after that.
+        """
+        if self.client.token_due() and check_cellular():
+            print("SAS token due for renewal, reconnecting")
+            self.client.renew_token()
+            if self.connected:
+                self.client.disconnect()
+                self.connected = False
+                self.connect()
+
     def check_message(self):
         try:
             if self.connected:
@@ -358,78 +552,112 @@ class AzureCloud:
 
 def update_cloud(client):
     print("update cloud")
-    if check_cellular():
+    # anything still queued goes first so the cloud sees the changes in order
+    if not outbox.pending() and check_cellular():
         if not client.is_connected():
             client.connect()
         if client.is_connected():
-            client.update(bulbs.get_light(), bulbs.get_night_light(), bulbs.get_lumens())
-            return True
-    return False
+            if client.update(bulbs.get_light(), bulbs.get_night_light(), bulbs.get_lumens()):
+                return True
+    # keep the reading on flash until it can be sent
+    outbox.append(bulbs.get_light(), bulbs.get_night_light(), bulbs.get_lumens())
+    return True
+
+
+def replay_outbox(client):
+    # rate limited by the replay period and batch size so a backlog doesn't flood the link
+    if outbox.pending() and check_cellular():
+        if not client.is_connected():
+            client.connect()
+        if client.is_connected():
+            client.replay(outbox)
 
 
 class Button:
     global bulbs
 
     def __init__(self):
-        self.button = Pin.board.D1
-        self.button.mode(Pin.IN)
-        self.button.pull(Pin.PULL_UP)
-        self.state = [1, 1]
+        self.button = DebouncedButton(Pin.board.D1)
 
     def check_button(self):
-        # set the previous state
-        self.state[0] = self.state[1]
-        # read the current button state
-        self.state[1] = self.button.value()
-        # detected button release
-        if self.state == [0, 1]:
-            print(self.state, bulbs.get_light(), bulbs.get_night_light())
+        pressed = False
+        # each queued release toggles the light, none are lost while the loop was busy
+        released_at = self.button.get()
+        while released_at is not None:
+            # how long the release waited for the loop to get to it
+            diagnostics.record_since_ms("button", released_at)
+            print('button press detected:', bulbs.get_light(), bulbs.get_night_light())
             bulbs.set_light(not bulbs.get_light())
-            return True
-        return False
+            pressed = True
+            released_at = self.button.get()
+        if pressed:
+            # write the LEDs now rather than at the next refresh
+            bulbs.sync_leds()
+        return pressed
 
 
 def __main():
     global bulbs, update_state
     button = Button()
     azure_client = AzureCloud()
-    lasttime = time()
     print("Waiting for network..")
     while not check_cellular():
         sleep(1)
     azure_client.connect()
+
+    def check_state():
+        global update_state
+        # Has any state changed requiring an update
+        if button.check_button():
+            update_state = UPDATE_CLOUD
+        if bulbs.update_nightlight():
+            update_state = UPDATE_CLOUD
+
+    def publish():
+        global update_state
+        # Light state has changed or cloud updated needed
+        if update_state == UPDATE_CLOUD:
+            # attempt to send an update
+            if update_cloud(azure_client):
+                # update successful, no more until change detected
+                update_state = UPDATE_NONE
+
+    def sample_telemetry():
+        if bulbs.is_connected():
+            lumens = bulbs.get_lumens()
+            # readings inside the deadband only count towards the window summary
+            if lumens_filter.add(lumens):
+                azure_client.sample(lumens)
+            elif azure_client.telemetry.due():
+                azure_client.flush_telemetry()
+            if lumens_filter.due() and azure_client.publish_summary(lumens_filter):
+                lumens_filter.clear()
+
+    lumens_filter = DeadbandFilter(absolute=lumens_deadband, relative=lumens_deadband_ratio,
+                                   window_ms=lumens_window_ms)
+
+    def publish_diagnostics():
+        azure_client.publish_diagnostics(diagnostics)
+        # start again even if it wasn't published, so the totals can't overflow while we're offline
+        diagnostics.clear()
+
+    scheduler = Scheduler(diagnostics, memory)
+    scheduler.add(check_state, periods_ms["state"], name="state")
+    scheduler.add(bulbs.connect, periods_ms["connect"], name="connect")
+    # Refresh the state of the sensors readings
+    scheduler.add(bulbs.update, periods_ms["ble"], periods_ms["ble"] // 2, name="ble")
+    scheduler.add(publish, periods_ms["publish"], name="publish")
+    scheduler.add(lambda: replay_outbox(azure_client), periods_ms["replay"], name="replay")
+    # Invoke callback
+    scheduler.add(azure_client.check_message, periods_ms["messages"], name="messages")
+    scheduler.add(sample_telemetry, periods_ms["telemetry"], name="telemetry")
+    scheduler.add(azure_client.check_token, periods_ms["token"], name="token")
+    scheduler.add(publish_diagnostics, periods_ms["diagnostics"], name="diagnostics")
     print("Entering loop")
-    while True:
-        try:
-            if not bulbs.is_connected():
-                bulbs.connect()
-            # Has any state changed requiring an update
-            if button.check_button():
-                update_state = UPDATE_CLOUD
-            if bulbs.update_nightlight():
-                update_state = UPDATE_CLOUD
-            # Invoke callback
-            azure_client.check_message()
-
-            # Wait until at least 1 second has elapsed before updating
-            if time() - lasttime > 1:
-                lasttime = time()
-                if bulbs.is_connected():
-                    # Refresh the state of the sensors readings
-                    bulbs.update()
-
-                # Light state has changed or cloud updated needed
-                if update_state == UPDATE_CLOUD:
-                    # attempt to send an update
-                    if update_cloud(azure_client):
-                        # update successful, no more until change detected
-                        update_state = UPDATE_NONE
-
-        except OSError as e:
-            # provide debug info, but keep going
-            print_exception(e)
+    scheduler.run()
 
 
 bulbs = BLESmartSwitch()
+outbox = Outbox()
 update_state = UPDATE_NONE
 __main()
@@ -0,0 +1,79 @@
+"""
+Copyright (c) 2020, Digi International, Inc.
+Sample code released under MIT License.
+
+Time to sign an Azure SAS token string with the original hmac_digest()
+and with the cached-key hmac_sha256 module.
+
+Run from the repository root with CPython or the MicroPython unix port:
+
+    python benchmarks/hmac_bench.py
+    micropython benchmarks/hmac_bench.py
+"""
+
+import sys
+sys.path.append("modules")
+
+from hashlib import sha256
+try:
+    from time import ticks_us, ticks_diff
+except ImportError:
+    from time import perf_counter
+
+    def ticks_us():
+        return int(perf_counter() * 1000000)
+
+    def ticks_diff(a, b):
+        return a - b
+
+from hmac_sha256 import hmac_digest
+
+ITERATIONS = 200
+key = bytes(range(32))
+message = b"myhub.azure-devices.net%2Fdevices%2Fsmartswitch\n1589216400"
+
+
+def hmac_digest_before(key, message):
+    trans_5C = bytes((x ^ 0x5C) for x in range(256))
+    trans_36 = bytes((x ^ 0x36) for x in range(256))
+    inner = sha256()
+    outer = sha256()
+    blocksize = 64
+    if len(key) > blocksize:
+        key = sha256(key).digest()
+    key = key + b'\x00' * (blocksize - len(key))
+    inner.update(bytes_translate(key, trans_36))
+    outer.update(bytes_translate(key, trans_5C))
+    inner.update(message)
+    outer.update(inner.digest())
+    return outer.digest()
+
+
+def bytes_translate(input_bytes, input_table):
+    output_bytes = []
+    for byte in input_bytes:
+        output_bytes.append(input_table[int(byte)])
+    return bytes(output_bytes)
+
+
+def us_per_call(fn):
+    start = ticks_us()
+    for _ in range(ITERATIONS):
+        fn(key, message)
+    return ticks_diff(ticks_us(), start) / ITERATIONS
+
+
+def main():
+    expected = hmac_digest_before(key, message)
+    assert hmac_digest(key, message) == expected
+    try:
+        import hmac
+        assert hmac.new(key, message, sha256).digest() == expected
+    except ImportError:
+        pass
+    print("microseconds per HMAC-SHA256 ({} calls)".format(ITERATIONS))
+    print("before {:>10.1f}".format(us_per_call(hmac_digest_before)))
+    print("after  {:>10.1f}".format(us_per_call(hmac_digest)))
+
+
+main()
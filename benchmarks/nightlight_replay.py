@@ -0,0 +1,106 @@
+"""
+Copyright (c) 2020, Digi International, Inc.
+Sample code released under MIT License.
+
+Cloud updates caused by night light changes on lumens traces, with the
+original raw threshold check and with NightLightDetector.
+
+Every night light change sets UPDATE_CLOUD, so each one is a publish.
+Traces are CSV files of "milliseconds,lumens" lines, as recorded from
+BLESmartSwitch readings. Without arguments a few synthetic traces are
+generated instead:
+
+    python benchmarks/nightlight_replay.py [trace.csv ...]
+    micropython benchmarks/nightlight_replay.py [trace.csv ...]
+"""
+
+import sys
+sys.path.append("modules")
+
+import time
+if not hasattr(time, "ticks_diff"):
+    # CPython, give the modules the MicroPython tick functions they use
+    time.ticks_ms = lambda: int(time.monotonic() * 1000)
+    time.ticks_diff = lambda a, b: a - b
+try:
+    from random import seed, randint
+except ImportError:
+    from urandom import seed, randint
+
+from nightlight import NightLightDetector
+
+PERIOD_MS = 1000
+
+
+def raw_threshold(trace):
+    # BLESmartSwitch.update_nightlight() before smoothing
+    state = False
+    changes = 0
+    for _, lumens in trace:
+        prev = state
+        if lumens < 20:
+            state = True
+        if lumens > 40:
+            state = False
+        changes += prev != state
+    return changes
+
+
+def smoothed(trace):
+    detector = NightLightDetector()
+    for ms, lumens in trace:
+        detector.add(lumens)
+        detector.update(ms)
+    return detector.changes
+
+
+def synthetic(name):
+    seed(len(name))
+    trace = []
+    transient = 0
+    for i in range(3600):
+        if name == "dusk":
+            # an hour of fading daylight, with passing car headlights once it's dark
+            level = 60 - 55 * i // 3600 + randint(-4, 4)
+            if transient == 0 and level < 20 and randint(0, 90) == 0:
+                transient = randint(1, 4)
+            if transient:
+                level += 50
+        elif name == "shadows":
+            # daylight, with someone walking past the sensor every few minutes
+            level = 50 + randint(-5, 5)
+            if transient == 0 and randint(0, 150) == 0:
+                transient = randint(1, 3)
+            if transient:
+                level = randint(5, 15)
+        else:
+            # a lamp switched on and off every ten minutes in a dark room
+            level = (200 if (i // 600) % 2 else 10) + randint(-5, 5)
+        transient = max(transient - 1, 0)
+        trace.append((i * PERIOD_MS, max(level, 0)))
+    return trace
+
+
+def load(path):
+    trace = []
+    with open(path) as f:
+        for line in f:
+            fields = line.strip().split(",")
+            if len(fields) == 2 and fields[0].isdigit():
+                trace.append((int(fields[0]), int(fields[1])))
+    return trace
+
+
+def main():
+    if len(sys.argv) > 1:
+        traces = [(path, load(path)) for path in sys.argv[1:]]
+    else:
+        traces = [(name + " (synthetic)", synthetic(name)) for name in ("dusk", "shadows", "lamp")]
+    print("{:<24} {:>8} {:>8} {:>8} {:>8}".format("trace", "samples", "before", "after", "avoided"))
+    for name, trace in traces:
+        before = raw_threshold(trace)
+        after = smoothed(trace)
+        print("{:<24} {:>8} {:>8} {:>8} {:>8}".format(name, len(trace), before, after, before - after))
+
+
+main()
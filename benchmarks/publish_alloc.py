@@ -0,0 +1,117 @@
+"""
+Copyright (c) 2020, Digi International, Inc.
+Sample code released under MIT License.
+
+Heap allocated per publish on the AWS shadow and Azure telemetry paths,
+before and after moving to precomputed topics and PayloadBuffer.
+
+Run from the repository root with CPython or the MicroPython unix port:
+
+    python benchmarks/publish_alloc.py
+    micropython benchmarks/publish_alloc.py
+"""
+
+import sys
+sys.path.append("modules")
+
+try:
+    import ujson
+except ImportError:
+    import json as ujson
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+import gc
+
+from payload import PayloadBuffer, LIGHT_STATE, NIGHT_LIGHT_STATE, LUMENS
+
+ITERATIONS = 1000
+imei = "0123456789012345"
+device_id = "smartswitch"
+
+
+def _get_on_off(value):
+    if value:
+        return 'on'
+    else:
+        return 'off'
+
+
+class Sink:
+    """Stands in for MQTTClient.publish() without touching the payload."""
+    def publish(self, topic, msg):
+        pass
+
+
+client = Sink()
+
+
+def shadow_before(light, nightlight, lumens):
+    state = {"state": {"reported": {"light_state": _get_on_off(light),
+                                    "night_light_state": _get_on_off(nightlight)}, "desired": None}}
+    shadow_path = "$aws/things/{}/shadow/".format(imei)
+    client.publish(shadow_path + "update", ujson.dumps(state))
+
+
+update_topic = "$aws/things/{}/shadow/update".format(imei).encode()
+shadow_buffer = PayloadBuffer()
+
+
+def shadow_after(light, nightlight, lumens):
+    shadow_buffer.reset().write(b'{"state":{"reported":{')
+    shadow_buffer.field_on_off(LIGHT_STATE, light, True).field_on_off(NIGHT_LIGHT_STATE, nightlight)
+    client.publish(update_topic, shadow_buffer.write(b'},"desired":null}}').payload())
+
+
+def azure_before(light, nightlight, lumens):
+    state = {"light_state": _get_on_off(light),
+             "night_light_state": _get_on_off(nightlight),
+             "lumens": lumens}
+    prop = {"name": "level", "value": "storage"}
+    properties = "%s=%s" % (prop['name'], prop['value'])
+    topic_string = "devices/{device_id}/messages/events/{p}".format(device_id=device_id, p=properties)
+    client.publish(topic_string, ujson.dumps(state))
+
+
+telemetry_topic = "devices/{}/messages/events/level=storage".format(device_id).encode()
+azure_buffer = PayloadBuffer()
+
+
+def azure_after(light, nightlight, lumens):
+    azure_buffer.reset().write(b'{')
+    azure_buffer.field_on_off(LIGHT_STATE, light, True).field_on_off(NIGHT_LIGHT_STATE, nightlight)
+    client.publish(telemetry_topic, azure_buffer.field_int(LUMENS, lumens).write(b'}').payload())
+
+
+def bytes_per_call(fn):
+    gc.collect()
+    if tracemalloc is not None:
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        total = 0
+        for i in range(ITERATIONS):
+            tracemalloc.reset_peak()
+            fn(i & 1, i & 2, i % 500)
+            total += tracemalloc.get_traced_memory()[1] - before
+        tracemalloc.stop()
+        return total / ITERATIONS
+    gc.disable()
+    total = 0
+    for i in range(ITERATIONS):
+        start = gc.mem_alloc()
+        fn(i & 1, i & 2, i % 500)
+        total += gc.mem_alloc() - start
+        gc.collect()
+    gc.enable()
+    return total / ITERATIONS
+
+
+def main():
+    print("bytes allocated per publish ({} calls)".format(ITERATIONS))
+    for name, before, after in (("aws shadow", shadow_before, shadow_after),
+                                ("azure telemetry", azure_before, azure_after)):
+        print("{:<16} before {:>8.1f}  after {:>8.1f}".format(name, bytes_per_call(before), bytes_per_call(after)))
+
+
+main()
@@ -6,16 +6,30 @@ Instructions:
 
  - Ensure that the umqtt/simple.py module is in the /flash/lib directory
    on the XBee Filesystem
+ - Copy the following files from modules/ to the /flash/lib directory on
+   the XBee Filesystem: gatt_cache.py, ble_helper.py, ble_scan.py,
+   ble_manager.py, scheduler.py, button.py, nightlight.py,
+   diagnostics.py, memory.py, payload.py.
+ - To control several Thunderboards, list their addresses in
+   thunderboard_addresses below. The button toggles all of them.
  - Push the reset or button left of the USB connector on the Silicon Labs
    Thundersense 2 to send advertisements for 30 seconds.
 
 """
 
-from time import time
 from struct import pack, unpack
 from digi import ble
+from gatt_cache import GATTCache
+from ble_helper import enable_notifications, WriteOnChange
+from ble_scan import BLEScanner
+from nightlight import NightLightDetector
+from ble_manager import BLEManager
+from scheduler import Scheduler
+from diagnostics import Diagnostics
+from memory import MemoryProfiler
+from button import DebouncedButton
+from ubinascii import unhexlify
 from machine import Pin
-from sys import print_exception
 
 # The service and characteristic UUIDs
 io_service_uuid = 0x1815
@@ -23,54 +37,105 @@ io_characteristic_uuid = 0x2A56
 
 env_service_uuid = 0x181a
 lumens_characteristic_uuid = 'c8546913-bfd9-45eb-8dde-9f8754f4a32e'
+
+# Characteristics used by the smart switch: name -> (service, characteristic, index)
+characteristic_specs = {
+    "leds": (io_service_uuid, io_characteristic_uuid, 1),
+    "lumens": (env_service_uuid, lumens_characteristic_uuid, 0),
+}
+
+# Set to True to have the board push lumens readings instead of polling them
+lumens_notify = False
+
+# The night light turns on below the first and off above the second smoothed lumens level,
+# once the level has stayed past the threshold for nightlight_dwell_ms
+nightlight_thresholds = (20, 40)
+nightlight_dwell_ms = 5000
+
+# Hex addresses of the Thunderboards to control, e.g. ["000b57aabbcc"].
+# Leave empty to scan for a single board.
+thunderboard_addresses = []
+
+# Task periods in milliseconds, lower means less latency but more power
+periods_ms = {
+    "state": 20,  # button and night light checks
+    "connect": 500,  # BLE connection attempts
+    "ble": 1000,  # BLE sensor reads and LED refresh
+    "diagnostics": 300000,  # operation counts and latencies printed
+}
+
+# Run gc.collect() between tasks once free heap falls below this many bytes, None leaves collections to the
+# allocator, which runs them whenever an allocation fails, possibly in the middle of a publish
+gc_collect_below = None
+
 ble.active(True)
+# times the blocking operations and samples the heap per task, see periods_ms["diagnostics"]
+memory = MemoryProfiler(collect_below=gc_collect_below)
+diagnostics = Diagnostics(size=3072, memory=memory)
 
 
 class BLESmartSwitch:
-    @staticmethod
-    def _find_thunderboard():
-        scanner = ble.gap_scan(200, interval_us=2500, window_us=2500)
-        for adv in scanner:
-            if b"Thunder Sense" in adv['payload']:
-                return adv['address']
-        return None
-
-    def __init__(self):
-        self.address = None
+    def __init__(self, address=None, notify=lumens_notify, scanner=None, gatt_cache=None):
+        """
+        :param address: Fixed board address, skips scanning, used when several boards are managed.
+        :param notify: Use lumens notifications instead of polling.
+        :param scanner: BLEScanner to share between switches, they would overwrite each other's file otherwise.
+        :param gatt_cache: GATTCache to share between switches, for the same reason.
+        """
+        self.address = address
+        self.fixed_address = address is not None
         self.conn = None
         self.lumens = 100
         self.leds_characteristic = None
         self.lumens_characteristic = None
         self.light_state = [0, 0]
-
-    def get_characteristics_from_uuids(self, service_uuid, characteristic_uuid):
-        services = list(self.conn.gattc_services(service_uuid))
-        if len(services):
-            # Assume that there is only one service per UUID, take the first one
-            my_service = services[0]
-            characteristics = list(self.conn.gattc_characteristics(my_service, characteristic_uuid))
-            return characteristics
-        # Couldn't find specified characteristic, return an empy list
-        return []
+        self.scanner = scanner if scanner is not None else BLEScanner(name=b"Thunder Sense")
+        self.gatt_cache = gatt_cache if gatt_cache is not None else GATTCache()
+        # polling is used as a fallback when the board can't notify
+        self.notify = notify
+        self.notifying = False
+        # only writes the LEDs when light_state changes
+        self.leds = WriteOnChange()
+        # smoothed, so noise around a threshold doesn't toggle the night light
+        self.night_light = NightLightDetector(nightlight_thresholds[0], nightlight_thresholds[1], nightlight_dwell_ms)
 
     def is_connected(self):
         return self.conn is not None
 
     def connect(self):
         if self.address is None:
-            self.address = self._find_thunderboard()
+            start = diagnostics.start()
+            self.address = self.scanner.find()
+            diagnostics.record("ble_scan", start)
         if self.conn is None:
             if self.address is not None:
                 try:
                     print("Attempting connection to: {}".format(self.address))
+                    start = diagnostics.start()
                     self.conn = ble.gap_connect(ble.ADDR_TYPE_PUBLIC, self.address)
-                    self.leds_characteristic = self.get_characteristics_from_uuids(io_service_uuid,
-                                                                                   io_characteristic_uuid)[1]
-                    self.lumens_characteristic = self.get_characteristics_from_uuids(env_service_uuid,
-                                                                                     lumens_characteristic_uuid)[0]
+                    # skips discovery when the handles for this board are already on flash
+                    characteristics = self.gatt_cache.resolve(self.conn, self.address, characteristic_specs)
+                    self.leds_characteristic = characteristics["leds"]
+                    self.lumens_characteristic = characteristics["lumens"]
+                    self.leds.attach(self.conn, self.leds_characteristic)
+                    if not self.fixed_address:
+                        self.scanner.remember(self.address)
+                    if self.notify:
+                        self.notifying = enable_notifications(self.conn, self.lumens_characteristic,
+                                                              self._lumens_received)
+                    diagnostics.record("ble_connect", start)
                     print("connected")
                 except OSError:
+                    diagnostics.record("ble_connect_failed", start)
                     self.conn = None
+                    self.notifying = False
+                    # an address remembered from a previous boot may be stale, scan next time
+                    if self.scanner.directed:
+                        self.address = None
+
+    def _lumens_received(self, data):
+        self.lumens = int(unpack('<I', data)[0]/100)
+        self.night_light.add(self.lumens)
 
     def get_lumens(self):
         return self.lumens
@@ -85,67 +150,91 @@ class BLESmartSwitch:
         self.light_state[0] = value
 
     def update_nightlight(self):
-        prev_light_state = self.light_state[1]
-        if self.lumens < 20:
-            self.light_state[1] = True
-        if self.lumens > 40:
-            self.light_state[1] = False
-        return prev_light_state != self.light_state[1]
+        if self.night_light.update():
+            self.light_state[1] = self.night_light.state
+            return True
+        return False
+
+    def sync_leds(self):
+        if self.conn is not None:
+            try:
+                self.leds.set(pack("b", self.light_state[0] | (self.light_state[1] << 2)))
+                writes = self.leds.writes
+                start = diagnostics.start()
+                self.leds.sync()
+                if self.leds.writes != writes:
+                    diagnostics.record("led_write", start)
+            except OSError:
+                self.conn = None
+                self.notifying = False
 
     def update(self):
+        self.sync_leds()
         if self.conn is not None:
             try:
-                led_value = pack("b", self.light_state[0] | (self.light_state[1] << 2))
-                self.conn.gattc_write_characteristic(self.leds_characteristic, led_value)
-                self.lumens = self.conn.gattc_read_characteristic(self.lumens_characteristic)
-                self.lumens = int(unpack('<I', self.lumens)[0]/100)
+                if not self.notifying:
+                    start = diagnostics.start()
+                    self._lumens_received(self.conn.gattc_read_characteristic(self.lumens_characteristic))
+                    diagnostics.record("gatt_read", start)
             except OSError:
                 self.conn = None
+                self.notifying = False
 
 
 class Button:
     def __init__(self):
-        self.button = Pin.board.D1
-        self.button.mode(Pin.IN)
-        self.button.pull(Pin.PULL_UP)
-        self.state = [1, 1]
+        self.button = DebouncedButton(Pin.board.D1)
 
     def check_button(self, bulbs):
-        # set the previous state
-        self.state[0] = self.state[1]
-        # read the current button state
-        self.state[1] = self.button.value()
-        # detected button release
-        if self.state == [0, 1]:
-            print('button press detected:', self.state, bulbs.get_light(), bulbs.get_night_light())
+        pressed = False
+        # each queued release toggles the light, none are lost while the loop was busy
+        released_at = self.button.get()
+        while released_at is not None:
+            # how long the release waited for the loop to get to it
+            diagnostics.record_since_ms("button", released_at)
+            print('button press detected:', bulbs.get_light(), bulbs.get_night_light())
             bulbs.set_light(not bulbs.get_light())
-            return True
-        return False
+            pressed = True
+            released_at = self.button.get()
+        if pressed:
+            # write the LEDs now rather than at the next refresh
+            bulbs.sync_leds()
+        return pressed
 
 
 def __main():
     button = Button()
-    bulbs = BLESmartSwitch()
-    lasttime = time()
-    while True:
-        try:
-            if not bulbs.is_connected():
-                bulbs.connect()
-            # Check for and update state
-            button.check_button(bulbs)
-            if bulbs.update_nightlight():
-                print("night light toggle at level:", bulbs.get_lumens())
-
-            # Wait until at least 1 second has elapsed before updating
-            if time() - lasttime > 1:
-                lasttime = time()
-                if bulbs.is_connected():
-                    # Refresh the state of the sensors readings
-                    bulbs.update()
-
-        except OSError as e:
-            # provide debug info, but keep going
-            print_exception(e)
+    if thunderboard_addresses:
+        # one cache for all boards, each saves the whole file
+        gatt_cache = GATTCache()
+        scanner = BLEScanner(name=b"Thunder Sense")
+        switches = [BLESmartSwitch(address=unhexlify(a), scanner=scanner, gatt_cache=gatt_cache)
+                    for a in thunderboard_addresses]
+    else:
+        switches = [BLESmartSwitch()]
+    manager = BLEManager(switches)
+    bulbs = switches[0]
+
+    def check_state():
+        if button.check_button(bulbs):
+            for other in switches[1:]:
+                other.set_light(bulbs.get_light())
+                other.sync_leds()
+        for switch in switches:
+            if switch.update_nightlight():
+                print("night light toggle at level:", switch.get_lumens())
+
+    def report_diagnostics():
+        diagnostics.print()
+        diagnostics.clear()
+
+    scheduler = Scheduler(diagnostics, memory)
+    scheduler.add(check_state, periods_ms["state"], name="state")
+    scheduler.add(manager.connect, periods_ms["connect"], name="connect")
+    # Refresh the state of the sensors readings
+    scheduler.add(manager.update, periods_ms["ble"], periods_ms["ble"] // 2, name="ble")
+    scheduler.add(report_diagnostics, periods_ms["diagnostics"], name="diagnostics")
+    scheduler.run()
 
 
 __main()
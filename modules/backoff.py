@@ -0,0 +1,81 @@
+"""
+Copyright (c) 2020, Digi International, Inc.
+Sample code released under MIT License.
+
+Reconnect policy with exponential backoff and jitter.
+
+A cloud connect is a full TLS and MQTT handshake, and retrying one on every
+pass of the loop while the service is unreachable keeps the BLE tasks and
+the button waiting and burns cellular data. Backoff decides when the next
+attempt may be made: the delay doubles after each failure up to max_ms,
+and a random part of it is taken off so a fleet of devices that lost the
+network together doesn't come back in step. When the cellular network
+comes back after being down, the next attempt is allowed at once.
+
+Copy this file to the /flash/lib directory on the XBee Filesystem.
+"""
+
+from time import ticks_ms, ticks_diff, ticks_add
+try:
+    from random import getrandbits
+except ImportError:
+    from time import ticks_us
+
+    def getrandbits(bits):
+        # the microsecond counter at the time of a failure is random enough to spread devices apart
+        return ticks_us() & ((1 << bits) - 1)
+
+
+class Backoff:
+    def __init__(self, initial_ms=2000, max_ms=300000, jitter=0.5):
+        """
+        :param initial_ms: Delay after the first failure.
+        :param max_ms: Upper bound for the delay.
+        :param jitter: Up to this fraction of each delay is taken off at random.
+        """
+        self.initial_ms = initial_ms
+        self.max_ms = max_ms
+        self.jitter = jitter
+        self.attempts = 0
+        self.failures = 0
+        # failures since the last success, the delay grows with these
+        self.consecutive = 0
+        self._delay = initial_ms
+        self._retry_at = None
+        self._network = True
+
+    def ready(self, network=True):
+        """
+        :param network: Whether the network is up, nothing is attempted while it isn't.
+        :return: True if an attempt may be made now.
+        """
+        if not network:
+            self._network = False
+            return False
+        if not self._network:
+            # the network is back, whatever failed before may work now
+            self._network = True
+            self.reset()
+        return self._retry_at is None or ticks_diff(ticks_ms(), self._retry_at) >= 0
+
+    def succeeded(self):
+        self.attempts += 1
+        self.reset()
+
+    def failed(self):
+        self.attempts += 1
+        self.failures += 1
+        self.consecutive += 1
+        wait = self._delay - int(self._delay * self.jitter) * getrandbits(8) // 255
+        self._retry_at = ticks_add(ticks_ms(), wait)
+        self._delay = min(self._delay * 2, self.max_ms)
+        print("next connection attempt in {} ms".format(wait))
+
+    def reset(self):
+        self.consecutive = 0
+        self._delay = self.initial_ms
+        self._retry_at = None
+
+    def print(self):
+        print("attempts: {}, failures: {}, consecutive failures: {}".format(
+            self.attempts, self.failures, self.consecutive))
@@ -1,8 +1,102 @@
-from digi import ble
+from ble_scan import BLEScanner
+
+# Characteristic property bits
+PROP_READ = 0x02
+PROP_WRITE_NO_RESP = 0x04
+PROP_NOTIFY = 0x10
+PROP_INDICATE = 0x20
+
+
+# one scanner per substring, so repeated calls keep its duty cycle
+_advertiser_scanners = {}
+
 
 def find_advertiser(substring):
-    scanner = ble.gap_scan(100, interval_us=2500, window_us=2500)
-    for adv in scanner:
-        if substring in adv['payload']:
-            return adv['address']
+    """
+    Scan for a peripheral whose raw advertising payload contains substring.
+    :return: The address of the strongest match, or None.
+    """
+    scanner = _advertiser_scanners.get(substring)
+    if scanner is None:
+        scanner = _advertiser_scanners[substring] = BLEScanner(payload=substring)
+    adv = scanner.scan()
+    if adv is not None:
+        return adv['address']
     return None
+
+
+def enable_notifications(conn, characteristic, callback):
+    """
+    Have the peripheral push values of a characteristic instead of polling it.
+    Notifications are preferred over indications since they are not acknowledged.
+    :param conn: A connection returned by ble.gap_connect().
+    :param characteristic: Characteristic tuple (handle, uuid, properties).
+    :param callback: Called with the new value each time one arrives.
+    :return: True if the characteristic was configured, False if it cannot notify or indicate.
+    """
+    properties = characteristic[2]
+    if properties & PROP_NOTIFY:
+        conn.gattc_configure(characteristic, callback, notification=True)
+    elif properties & PROP_INDICATE:
+        conn.gattc_configure(characteristic, callback, indication=True)
+    else:
+        return False
+    return True
+
+
+class WriteOnChange:
+    """
+    Keep a characteristic in sync with a desired value, writing only when the value changes.
+    Writes use write-without-response when the characteristic supports it so they don't block,
+    such writes are confirmed by reading the characteristic back on the following sync().
+    """
+    def __init__(self):
+        self.conn = None
+        self.characteristic = None
+        self.value = None
+        self.written = None
+        self.confirmed = True
+        self.no_response = False
+        self.writes = 0
+
+    def attach(self, conn, characteristic):
+        self.conn = conn
+        self.characteristic = characteristic
+        self.no_response = bool(characteristic[2] & PROP_WRITE_NO_RESP)
+        # the state of the peripheral is unknown after a connect, write it again
+        self.written = None
+
+    def set(self, value):
+        self.value = value
+
+    def _write(self, value):
+        if self.no_response:
+            try:
+                self.conn.gattc_write_characteristic(self.characteristic, value, response=False)
+                return
+            except TypeError:
+                # firmware without write-without-response support, use acknowledged writes from now on
+                self.no_response = False
+        self.conn.gattc_write_characteristic(self.characteristic, value)
+
+    def sync(self):
+        """
+        Write the desired value if it changed, or confirm the last unacknowledged write.
+        :return: True if a write was made.
+        """
+        if self.conn is None or self.value is None:
+            return False
+        if self.written != self.value:
+            self._write(self.value)
+            self.written = self.value
+            self.writes += 1
+            # acknowledged writes are already confirmed by the peripheral
+            self.confirmed = not self.no_response
+            return True
+        if not self.confirmed and self.characteristic[2] & PROP_READ:
+            if bytes(self.conn.gattc_read_characteristic(self.characteristic)) != self.value:
+                print("write not applied, retrying")
+                self.written = None
+                return False
+        self.confirmed = True
+        return False
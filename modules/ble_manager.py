@@ -0,0 +1,80 @@
+"""
+Copyright (c) 2020, Digi International, Inc.
+Sample code released under MIT License.
+
+Multi-peripheral BLE manager.
+
+BLEManager holds several BLESmartSwitch sessions. Each call to update()
+refreshes connected sessions round-robin until the per-tick time budget is
+used up, and the next call carries on where the last one stopped. Sessions
+that fail to connect are retried with a per-peripheral exponential backoff,
+and at most one connection attempt is made per call, so a dead sensor
+can't stall the others.
+
+Copy this file to the /flash/lib directory on the XBee Filesystem.
+"""
+
+from time import ticks_ms, ticks_diff, ticks_add
+
+
+class BLEManager:
+    def __init__(self, sessions, budget_ms=500, backoff_ms=1000, max_backoff_ms=16000):
+        """
+        :param sessions: Objects with connect(), is_connected() and update(), e.g. BLESmartSwitch.
+        :param budget_ms: Time update() may spend per call before deferring the remaining sessions.
+        :param backoff_ms: First delay before retrying a session that failed to connect.
+        :param max_backoff_ms: Upper bound for the retry delay.
+        """
+        self.sessions = sessions
+        self.budget_ms = budget_ms
+        self.backoff_ms = backoff_ms
+        self.max_backoff_ms = max_backoff_ms
+        self._next_update = 0
+        self._next_connect = 0
+        self._retry_at = [None] * len(sessions)
+        self._backoff = [backoff_ms] * len(sessions)
+
+    def connected(self):
+        return [s for s in self.sessions if s.is_connected()]
+
+    def connect(self):
+        """
+        Make at most one connection attempt, for the next disconnected session whose backoff has expired.
+        """
+        now = ticks_ms()
+        count = len(self.sessions)
+        for _ in range(count):
+            i = self._next_connect
+            self._next_connect = (i + 1) % count
+            session = self.sessions[i]
+            if session.is_connected():
+                continue
+            if self._retry_at[i] is not None and ticks_diff(self._retry_at[i], now) > 0:
+                continue
+            session.connect()
+            if session.is_connected():
+                self._retry_at[i] = None
+                self._backoff[i] = self.backoff_ms
+            else:
+                self._retry_at[i] = ticks_add(ticks_ms(), self._backoff[i])
+                self._backoff[i] = min(self._backoff[i] * 2, self.max_backoff_ms)
+            return
+
+    def update(self):
+        """
+        Refresh connected sessions round-robin within the time budget.
+        :return: Number of sessions refreshed.
+        """
+        start = ticks_ms()
+        count = len(self.sessions)
+        updated = 0
+        for _ in range(count):
+            session = self.sessions[self._next_update]
+            self._next_update = (self._next_update + 1) % count
+            if session.is_connected():
+                session.update()
+                updated += 1
+                if ticks_diff(ticks_ms(), start) >= self.budget_ms:
+                    # out of time, the rest go first next time
+                    break
+        return updated
@@ -0,0 +1,161 @@
+"""
+Copyright (c) 2020, Digi International, Inc.
+Sample code released under MIT License.
+
+Configurable BLE scan engine.
+
+BLEScanner parses the AD structures of each advertisement and matches them by
+address, local name, service UUID or bytes anywhere in the raw payload. Matching candidates are ranked by RSSI,
+the scan stops early on a strong match, and the duty cycle is lowered after
+every scan that finds nothing so an absent peripheral doesn't keep the radio
+busy. The address of the last peripheral that was connected is kept on flash
+so the next boot can connect to it directly without scanning.
+
+Copy this file to the /flash/lib directory on the XBee Filesystem.
+"""
+
+import ujson
+from digi import ble
+from ubinascii import hexlify, unhexlify
+
+# AD structure types
+AD_UUID16_INCOMPLETE = 0x02
+AD_UUID16_COMPLETE = 0x03
+AD_UUID128_INCOMPLETE = 0x06
+AD_UUID128_COMPLETE = 0x07
+AD_NAME_SHORT = 0x08
+AD_NAME_COMPLETE = 0x09
+
+# (duration_ms, interval_us, window_us) from 100% duty cycle down to 10%
+DUTY_CYCLES = ((200, 2500, 2500),
+               (400, 10000, 5000),
+               (800, 25000, 2500))
+
+LAST_ADDRESS_FILE = "/flash/ble_scan.json"
+
+
+def parse_advertisement(payload):
+    """
+    Split an advertising payload into its AD structures.
+    :param payload: Raw advertising data.
+    :return: (local name, list of 16-bit UUIDs, list of 128-bit UUIDs as little endian bytes)
+    """
+    name = None
+    uuid16 = []
+    uuid128 = []
+    i = 0
+    while i < len(payload):
+        length = payload[i]
+        if length == 0 or i + 1 + length > len(payload):
+            # padding or truncated structure
+            break
+        ad_type = payload[i + 1]
+        data = payload[i + 2:i + 1 + length]
+        if ad_type == AD_NAME_COMPLETE or (ad_type == AD_NAME_SHORT and name is None):
+            name = bytes(data)
+        elif ad_type == AD_UUID16_INCOMPLETE or ad_type == AD_UUID16_COMPLETE:
+            for j in range(0, len(data) - 1, 2):
+                uuid16.append(data[j] | (data[j + 1] << 8))
+        elif ad_type == AD_UUID128_INCOMPLETE or ad_type == AD_UUID128_COMPLETE:
+            for j in range(0, len(data) - 15, 16):
+                uuid128.append(bytes(data[j:j + 16]))
+        i += 1 + length
+    return name, uuid16, uuid128
+
+
+class BLEScanner:
+    def __init__(self, address=None, name=None, service_uuid=None, strong_rssi=-60,
+                 path=LAST_ADDRESS_FILE, payload=None):
+        """
+        :param address: Match this peer address exactly.
+        :param name: Match advertisements whose local name contains these bytes.
+        :param payload: Match advertisements whose raw payload contains these bytes, in any AD structure.
+        :param service_uuid: Match advertised services, an int for 16-bit UUIDs or
+                             16 little endian bytes for 128-bit UUIDs.
+        :param strong_rssi: Stop scanning as soon as a match at least this strong is seen.
+        :param path: File on flash used to remember the last good address.
+        """
+        self.address = address
+        self.name = name
+        self.service_uuid = service_uuid
+        self.payload = payload
+        self.strong_rssi = strong_rssi
+        self.path = path
+        self.level = 0
+        self.scans = 0
+        # True when the last address returned by find() came from flash without a scan
+        self.directed = False
+        self._remembered = self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return unhexlify(ujson.load(f)["address"])
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def remember(self, address):
+        if address == self._remembered:
+            return
+        self._remembered = address
+        try:
+            with open(self.path, "w") as f:
+                ujson.dump({"address": hexlify(address).decode()}, f)
+        except OSError as e:
+            print("unable to save address:", e)
+
+    def matches(self, adv):
+        if self.address is not None and adv['address'] != self.address:
+            return False
+        if self.payload is not None and self.payload not in adv['payload']:
+            return False
+        if self.name is None and self.service_uuid is None:
+            return True
+        name, uuid16, uuid128 = parse_advertisement(adv['payload'])
+        if self.name is not None and (name is None or self.name not in name):
+            return False
+        if self.service_uuid is not None:
+            if isinstance(self.service_uuid, int):
+                return self.service_uuid in uuid16
+            return bytes(self.service_uuid) in uuid128
+        return True
+
+    def scan(self):
+        """
+        Run one scan at the current duty cycle.
+        :return: The advertisement of the strongest match, or None.
+        """
+        duration_ms, interval_us, window_us = DUTY_CYCLES[self.level]
+        self.scans += 1
+        best = None
+        scanner = ble.gap_scan(duration_ms, interval_us=interval_us, window_us=window_us)
+        try:
+            for adv in scanner:
+                if (best is None or adv['rssi'] > best['rssi']) and self.matches(adv):
+                    best = adv
+                    if adv['rssi'] >= self.strong_rssi or self.address is not None:
+                        # good enough, no need to keep the radio on
+                        break
+        finally:
+            scanner.stop()
+        if best is None:
+            # nothing around, scan less aggressively next time
+            self.level = min(self.level + 1, len(DUTY_CYCLES) - 1)
+        else:
+            self.level = 0
+        return best
+
+    def find(self):
+        """
+        Get the address of the peripheral to connect to. The remembered address is tried
+        first without scanning, afterwards a scan is done on every call.
+        :return: The peer address or None.
+        """
+        if self._remembered is not None and not self.directed and self.scans == 0:
+            self.directed = True
+            return self._remembered
+        self.directed = False
+        adv = self.scan()
+        if adv is not None:
+            return adv['address']
+        return None
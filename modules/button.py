@@ -0,0 +1,75 @@
+"""
+Copyright (c) 2020, Digi International, Inc.
+Sample code released under MIT License.
+
+Interrupt driven, debounced push button.
+
+DebouncedButton records each button release in a small ring buffer from a
+pin interrupt, so presses are not lost while the main loop is blocked in a
+scan, a connect or a publish. Edges closer together than the debounce time
+are treated as contact bounce. The interrupt handler does not allocate; it
+only stores the ticks_ms() timestamp of the release. On firmware without
+Pin.irq() the pin is sampled on every call to get() instead.
+
+Copy this file to the /flash/lib directory on the XBee Filesystem.
+"""
+
+from array import array
+from machine import Pin
+from time import ticks_ms, ticks_diff
+
+
+class DebouncedButton:
+    def __init__(self, pin, debounce_ms=30, size=8):
+        """
+        :param pin: The button pin, pulled up and grounded while pressed.
+        :param debounce_ms: Edges closer together than this are contact bounce.
+        :param size: Number of releases that can be queued before new ones are dropped.
+        """
+        self.pin = pin
+        self.pin.mode(Pin.IN)
+        self.pin.pull(Pin.PULL_UP)
+        self.debounce_ms = debounce_ms
+        self.dropped = 0
+        self._events = array('i', [0] * size)
+        self._head = 0
+        self._tail = 0
+        self._level = self.pin.value()
+        self._last_edge = ticks_ms()
+        try:
+            self.pin.irq(handler=self._irq, trigger=Pin.IRQ_FALLING | Pin.IRQ_RISING)
+            self.interrupts = True
+        except (AttributeError, ValueError, OSError):
+            print("button interrupts not available, polling")
+            self.interrupts = False
+
+    def _edge(self, level, now):
+        settled = ticks_diff(now, self._last_edge) >= self.debounce_ms
+        self._last_edge = now
+        # a release is a rising edge after the button was held low long enough
+        if level and not self._level and settled:
+            head = (self._head + 1) % len(self._events)
+            if head == self._tail:
+                self.dropped += 1
+            else:
+                self._events[self._head] = now
+                self._head = head
+        self._level = level
+
+    def _irq(self, pin):
+        level = pin.value()
+        if level != self._level:
+            self._edge(level, ticks_ms())
+
+    def get(self):
+        """
+        Take the oldest release from the queue.
+        :return: ticks_ms() timestamp of the release, or None if there are no releases queued.
+        """
+        if not self.interrupts:
+            self._irq(self.pin)
+        if self._tail == self._head:
+            return None
+        timestamp = self._events[self._tail]
+        self._tail = (self._tail + 1) % len(self._events)
+        return timestamp
@@ -0,0 +1,99 @@
+"""
+Copyright (c) 2020, Digi International, Inc.
+Sample code released under MIT License.
+
+Deadband and windowed aggregation for sensor readings.
+
+Under steady lighting the lumens reading wanders by a few counts from one
+read to the next, and forwarding every reading spends messages on noise.
+DeadbandFilter sits between the sensor read and the cloud publish: add()
+only reports a reading as worth publishing when it has moved outside the
+deadband around the last one reported, either an absolute amount or a
+fraction of that value, whichever is wider. Every reading also goes into
+the min, max, sum and count of the current window, kept in an array, and
+when the window ends the owner publishes that summary:
+
+    {"lumens": {"min": 48, "max": 55, "mean": 51, "count": 300}}
+
+Copy this file to the /flash/lib directory on the XBee Filesystem.
+"""
+
+from array import array
+from time import ticks_ms, ticks_diff
+from payload import LUMENS
+
+MIN, MAX, SUM, COUNT = 0, 1, 2, 3
+
+
+class DeadbandFilter:
+    def __init__(self, name=LUMENS, absolute=5, relative=0.1, window_ms=300000):
+        """
+        :param name: Field template for the summary payload.
+        :param absolute: Smallest change worth publishing, None to only use relative.
+        :param relative: Smallest change worth publishing as a fraction of the last value, None to only use absolute.
+        :param window_ms: Length of a summary window.
+        """
+        self.name = name
+        self.absolute = absolute
+        self.relative = relative
+        self.window_ms = window_ms
+        self.stats = array('i', [0, 0, 0, 0])
+        self.last = None
+        self.published = 0
+        self.suppressed = 0
+        self._window_start = ticks_ms()
+
+    def _band(self):
+        band = 0
+        if self.absolute is not None:
+            band = self.absolute
+        if self.relative is not None:
+            band = max(band, int(abs(self.last) * self.relative))
+        return band
+
+    def add(self, value):
+        """
+        Take a reading.
+        :return: True if it changed enough from the last reading reported to be published now.
+        """
+        stats = self.stats
+        if stats[COUNT] == 0:
+            stats[MIN] = stats[MAX] = value
+        else:
+            if value < stats[MIN]:
+                stats[MIN] = value
+            if value > stats[MAX]:
+                stats[MAX] = value
+        stats[SUM] += value
+        stats[COUNT] += 1
+        if self.last is None or abs(value - self.last) > self._band():
+            self.last = value
+            self.published += 1
+            return True
+        self.suppressed += 1
+        return False
+
+    def due(self):
+        """
+        :return: True when the window has ended and holds readings.
+        """
+        return self.stats[COUNT] > 0 and ticks_diff(ticks_ms(), self._window_start) >= self.window_ms
+
+    def mean(self):
+        return self.stats[SUM] // self.stats[COUNT] if self.stats[COUNT] else 0
+
+    def write(self, out):
+        """
+        Write the window summary as a JSON object into a PayloadBuffer.
+        """
+        stats = self.stats
+        out.write(b'{').write(self.name).write(b'{"min":').write_int(stats[MIN])
+        out.write(b',"max":').write_int(stats[MAX]).write(b',"mean":').write_int(self.mean())
+        return out.write(b',"count":').write_int(stats[COUNT]).write(b'}}')
+
+    def clear(self):
+        """
+        Start the next window.
+        """
+        self.stats[SUM] = self.stats[COUNT] = 0
+        self._window_start = ticks_ms()
@@ -0,0 +1,94 @@
+"""
+Copyright (c) 2020, Digi International, Inc.
+Sample code released under MIT License.
+
+Device request router for Digi Remote Manager.
+
+A device request names a target and carries a body, and whatever is
+written back before the request is closed is the response, so a command
+and its answer take a single round trip. RequestRouter looks the target
+up in a table of handlers. Handlers read the body in chunks and write the
+response as they go, so neither side has to be held in the heap at once;
+chunks() and lines() help with that.
+
+Copy this file to the /flash/lib directory on the XBee Filesystem.
+"""
+
+from digi import cloud
+from sys import print_exception
+
+
+class RequestRouter:
+    def __init__(self, default=None, chunk_size=64):
+        """
+        :param default: Handler for requests without a target, or with one that isn't in the table.
+        :param chunk_size: Bytes read from a request body at a time.
+        """
+        self.handlers = {}
+        self.default = default
+        self.chunk_size = chunk_size
+        self.handled = 0
+
+    def add(self, target, handler):
+        """
+        :param target: Device request target name.
+        :param handler: Called as handler(request), writes its response to the request.
+        """
+        self.handlers[target] = handler
+
+    def chunks(self, request):
+        """
+        Iterate over the request body chunk_size bytes at a time.
+        """
+        while True:
+            data = request.read(self.chunk_size)
+            if not data:
+                return
+            yield data
+
+    def lines(self, request):
+        """
+        Iterate over the lines of the request body, only one line is held at a time.
+        """
+        line = b""
+        for data in self.chunks(request):
+            line += data
+            while True:
+                end = line.find(b"\n")
+                if end < 0:
+                    break
+                yield line[:end].strip()
+                line = line[end + 1:]
+        if line.strip():
+            yield line.strip()
+
+    def dispatch(self, request):
+        # firmware without request targets sends everything to the default handler
+        target = getattr(request, "target", None)
+        handler = self.handlers.get(target, self.default)
+        print("device request for target: {}".format(target))
+        try:
+            if handler is None:
+                request.write("ERROR unknown target\n")
+            else:
+                handler(request)
+            self.handled += 1
+        except (OSError, ValueError) as e:
+            print_exception(e)
+            try:
+                request.write("ERROR {}\n".format(e))
+            except OSError:
+                pass
+        finally:
+            request.close()
+
+    def check(self):
+        """
+        Answer the next waiting device request, if there is one.
+        :return: True if a request was handled.
+        """
+        request = cloud.device_request_receive()
+        if request is None:
+            return False
+        self.dispatch(request)
+        return True
@@ -0,0 +1,127 @@
+"""
+Copyright (c) 2020, Digi International, Inc.
+Sample code released under MIT License.
+
+Operation counters and latency histograms.
+
+Scans, BLE connects, GATT reads, MQTT publishes and message checks all
+block the main loop. Diagnostics times them with ticks_us() and keeps, per
+operation, the number of calls, the total and the worst time, and a
+histogram over fixed buckets, all in one preallocated array so recording
+doesn't allocate. A snapshot is written as JSON into a PayloadBuffer for
+publishing, and the counters start again after each snapshot, "period"
+being the seconds it covers:
+
+    {"period": 300, "ops": {"gatt_read": {"n": 300, "avg": 41250, "max": 180032,
+                                           "hist": [0, 12, 280, 8, 0]}}}
+
+Times are in microseconds. The histogram counts calls up to 1 ms, 10 ms,
+100 ms, 1 s and longer. With a MemoryProfiler its report is included as
+"memory".
+
+Copy this file to the /flash/lib directory on the XBee Filesystem.
+"""
+
+from array import array
+from time import ticks_us, ticks_diff, ticks_ms
+from payload import PayloadBuffer
+
+# upper bounds of the histogram buckets, the last bucket holds everything slower
+BUCKETS_US = (1000, 10000, 100000, 1000000)
+COUNT, TOTAL, MAX, HIST = 0, 1, 2, 3
+
+
+class Diagnostics:
+    def __init__(self, buckets_us=BUCKETS_US, size=2048, memory=None):
+        """
+        :param buckets_us: Upper bounds of the histogram buckets in microseconds.
+        :param size: Bytes set aside for a snapshot payload.
+        :param memory: Optional MemoryProfiler to include in snapshots.
+        """
+        self.buckets_us = buckets_us
+        self.memory = memory
+        self.ops = {}
+        self.out = PayloadBuffer(size)
+        self._since = ticks_ms()
+
+    def operation(self, name):
+        """
+        Set up the counters for an operation, so the first record() doesn't allocate them.
+        :return: The name, for use with record().
+        """
+        if name not in self.ops:
+            self.ops[name] = array('i', [0] * (HIST + len(self.buckets_us) + 1))
+        return name
+
+    def start(self):
+        return ticks_us()
+
+    def record(self, name, start):
+        """
+        Count an operation that started at the ticks_us() timestamp start.
+        """
+        self.record_us(name, ticks_diff(ticks_us(), start))
+
+    def record_since_ms(self, name, start_ms):
+        """
+        Count an operation that started at the ticks_ms() timestamp start_ms, e.g. a button release.
+        """
+        self.record_us(name, ticks_diff(ticks_ms(), start_ms) * 1000)
+
+    def record_us(self, name, elapsed_us):
+        op = self.ops.get(name)
+        if op is None:
+            op = self.ops[self.operation(name)]
+        op[COUNT] += 1
+        op[TOTAL] += elapsed_us
+        if elapsed_us > op[MAX]:
+            op[MAX] = elapsed_us
+        bucket = 0
+        for bound in self.buckets_us:
+            if elapsed_us <= bound:
+                break
+            bucket += 1
+        op[HIST + bucket] += 1
+
+    def payload(self):
+        """
+        :return: The counters since the last snapshot as JSON.
+        """
+        out = self.out.reset()
+        out.write(b'{"period":').write_int(ticks_diff(ticks_ms(), self._since) // 1000).write(b',"ops":{')
+        first = True
+        for name, op in self.ops.items():
+            if not op[COUNT]:
+                continue
+            if not first:
+                out.write(b',')
+            first = False
+            out.write(b'"').write(name.encode()).write(b'":{"n":').write_int(op[COUNT])
+            out.write(b',"avg":').write_int(op[TOTAL] // op[COUNT]).write(b',"max":').write_int(op[MAX])
+            out.write(b',"hist":[')
+            for i in range(HIST, len(op)):
+                if i > HIST:
+                    out.write(b',')
+                out.write_int(op[i])
+            out.write(b']}')
+        out.write(b'}')
+        if self.memory is not None:
+            self.memory.write(out.write(b',"memory":'))
+        return out.write(b'}').payload()
+
+    def clear(self):
+        self._since = ticks_ms()
+        if self.memory is not None:
+            self.memory.clear()
+        for op in self.ops.values():
+            for i in range(len(op)):
+                op[i] = 0
+
+    def print(self):
+        print("{:<14} {:>6} {:>10} {:>10}  histogram {}".format("operation", "count", "avg us", "max us",
+                                                               self.buckets_us))
+        for name, op in self.ops.items():
+            print("{:<14} {:>6} {:>10} {:>10}  {}".format(name, op[COUNT], op[TOTAL] // op[COUNT] if op[COUNT] else 0,
+                                                         op[MAX], list(op[HIST:])))
+        if self.memory is not None:
+            self.memory.print()
@@ -0,0 +1,119 @@
+"""
+Copyright (c) 2020, Digi International, Inc.
+Sample code released under MIT License.
+
+Persistent GATT handle cache.
+
+Enumerating services and characteristics over the air costs seconds every
+time a peripheral reconnects. GATTCache discovers the characteristics an
+application needs once, records their handles and properties on the XBee
+flash keyed by the peer address, and hands them back on later connections
+so discovery can be skipped. If the cached handles stop working the entry
+is dropped and a full rediscovery is done.
+
+Copy this file to the /flash/lib directory on the XBee Filesystem.
+"""
+
+import ujson
+from ubinascii import hexlify
+
+# Bit in the characteristic properties that marks it as readable
+PROP_READ = 0x02
+
+CACHE_FILE = "/flash/gatt_cache.json"
+
+
+class GATTCache:
+    def __init__(self, path=CACHE_FILE):
+        self.path = path
+        self._entries = self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return ujson.load(f)
+        except (OSError, ValueError):
+            # no cache yet or it is corrupt, start over
+            return {}
+
+    def _save(self):
+        try:
+            with open(self.path, "w") as f:
+                ujson.dump(self._entries, f)
+        except OSError as e:
+            print("unable to save GATT cache:", e)
+
+    @staticmethod
+    def _key(address):
+        return hexlify(address).decode()
+
+    def forget(self, address):
+        if self._entries.pop(self._key(address), None) is not None:
+            self._save()
+
+    @staticmethod
+    def discover(conn, specs):
+        """
+        Do a single discovery pass for the characteristics described by specs.
+        :param conn: A connection returned by ble.gap_connect().
+        :param specs: dict of name -> (service uuid, characteristic uuid, index). The index selects
+                      between characteristics sharing the same UUID within a service.
+        :return: dict of name -> characteristic tuple (handle, uuid, properties).
+        """
+        services = {}
+        found = {}
+        for name, (service_uuid, characteristic_uuid, index) in specs.items():
+            # each service is only enumerated once no matter how many characteristics it holds
+            if service_uuid not in services:
+                matches = list(conn.gattc_services(service_uuid))
+                if not len(matches):
+                    raise OSError("service {} not found".format(service_uuid))
+                # Assume that there is only one service per UUID, take the first one
+                services[service_uuid] = matches[0]
+            characteristics = list(conn.gattc_characteristics(services[service_uuid], characteristic_uuid))
+            if len(characteristics) <= index:
+                raise OSError("characteristic {} not found".format(characteristic_uuid))
+            found[name] = characteristics[index]
+        return found
+
+    def _from_cache(self, address, specs):
+        entry = self._entries.get(self._key(address))
+        if entry is None:
+            return None
+        found = {}
+        for name, (service_uuid, characteristic_uuid, index) in specs.items():
+            if name not in entry:
+                return None
+            handle, properties = entry[name]
+            found[name] = (handle, characteristic_uuid, properties)
+        return found
+
+    @staticmethod
+    def _verify(conn, characteristics):
+        # A single read of a readable characteristic proves the handles are still valid
+        for characteristic in characteristics.values():
+            if characteristic[2] & PROP_READ:
+                conn.gattc_read_characteristic(characteristic)
+                return
+
+    def resolve(self, conn, address, specs):
+        """
+        Get the characteristics for a connected peer, from the cache when possible.
+        :param conn: A connection returned by ble.gap_connect().
+        :param address: The peer address used as the cache key.
+        :param specs: See discover().
+        :return: dict of name -> characteristic tuple (handle, uuid, properties).
+        """
+        characteristics = self._from_cache(address, specs)
+        if characteristics is not None:
+            try:
+                self._verify(conn, characteristics)
+                print("using cached GATT handles")
+                return characteristics
+            except OSError:
+                print("cached GATT handles failed, rediscovering")
+                self.forget(address)
+        characteristics = self.discover(conn, specs)
+        self._entries[self._key(address)] = {name: [c[0], c[2]] for name, c in characteristics.items()}
+        self._save()
+        return characteristics
@@ -0,0 +1,63 @@
+"""
+Copyright (c) 2020, Digi International, Inc.
+Sample code released under MIT License.
+
+HMAC-SHA256 with the keyed state computed once per key.
+
+The key only has to be padded and XORed with the ipad/opad constants once.
+HMACSHA256 does that in a bytearray when it is created, and feeds the
+results into two SHA-256 objects. Where the hash objects can be copied
+(CPython) each digest starts from copies of that keyed state. Where they
+can't (MicroPython) it starts from the cached pads. hmac_digest() keeps one
+HMACSHA256 per key, so generating a SAS token again for the same
+SharedAccessKey, e.g. on a reconnect, skips the key setup entirely.
+
+Copy this file to the /flash/lib directory on the XBee Filesystem.
+"""
+
+from hashlib import sha256
+
+BLOCK_SIZE = 64
+
+_instances = {}
+
+
+class HMACSHA256:
+    def __init__(self, key: bytes):
+        if len(key) > BLOCK_SIZE:
+            key = sha256(key).digest()
+        self._ipad = bytearray(BLOCK_SIZE)
+        self._opad = bytearray(BLOCK_SIZE)
+        for i in range(BLOCK_SIZE):
+            k = key[i] if i < len(key) else 0
+            self._ipad[i] = k ^ 0x36
+            self._opad[i] = k ^ 0x5C
+        self._inner = sha256(self._ipad)
+        # MicroPython hash objects have no copy(), fall back to hashing the cached pads
+        self._copy = hasattr(self._inner, "copy")
+        self._outer = sha256(self._opad) if self._copy else None
+
+    def digest(self, message: bytes) -> bytes:
+        if self._copy:
+            inner = self._inner.copy()
+            outer = self._outer.copy()
+        else:
+            inner = sha256(self._ipad)
+            outer = sha256(self._opad)
+        inner.update(message)
+        outer.update(inner.digest())
+        return outer.digest()
+
+
+def hmac_digest(key: bytes, message: bytes) -> bytes:
+    """
+    A MicroPython implementation of HMAC.digest(), because HMAC isn't accessible yet.
+    :param key: key for the keyed hash object.
+    :param message: input for the digest.
+    :return: digest of the message passed in.
+    """
+    key = bytes(key)
+    instance = _instances.get(key)
+    if instance is None:
+        instance = _instances[key] = HMACSHA256(key)
+    return instance.digest(message)
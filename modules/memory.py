@@ -0,0 +1,140 @@
+"""
+Copyright (c) 2020, Digi International, Inc.
+Sample code released under MIT License.
+
+Heap profiling and idle time garbage collection.
+
+The MicroPython heap on the XBee is small, and an app that runs for hours
+can end in MemoryError. MemoryProfiler samples gc.mem_alloc() before and
+after each call of a component, for the Scheduler each task, and keeps
+per component the bytes allocated, the largest allocation by one call,
+the peak heap in use and how many calls were interrupted by a collection
+(the heap shrank across the call, so the allocator ran out and collected
+in the middle of it, e.g. mid-publish). A report is written as JSON,
+sizes in bytes and pauses in microseconds:
+
+    {"heap": 65536, "low": 9120, "gc": {"n": 12, "total": 61200, "max": 6800},
+     "components": {"cloud": {"peak": 48210, "alloc": 96000, "max": 1400, "gc": 3}}}
+
+The scheduled collection policy is opt-in: with collect_below set, idle()
+runs gc.collect() while the Scheduler has nothing due, once free heap has
+dropped below that many bytes, so collections happen between tasks
+instead of inside them.
+
+Copy this file to the /flash/lib directory on the XBee Filesystem.
+"""
+
+import gc
+from array import array
+from time import ticks_us, ticks_diff
+
+PEAK, ALLOC, MAX, COLLECTED = 0, 1, 2, 3
+
+
+class MemoryProfiler:
+    def __init__(self, collect_below=None, min_idle_ms=20):
+        """
+        :param collect_below: Collect when idle and free heap is below this many bytes, None to leave
+        collections to the allocator.
+        :param min_idle_ms: Only collect when at least this long is left before the next task is due.
+        """
+        self.collect_below = collect_below
+        self.min_idle_ms = min_idle_ms
+        self.components = {}
+        # mem_alloc() + mem_free() doesn't change, so one call gives both
+        self.heap = gc.mem_alloc() + gc.mem_free()
+        self.low = self.heap - gc.mem_alloc()
+        self.collections = 0
+        self.pause_total = 0
+        self.pause_max = 0
+
+    def component(self, name):
+        """
+        Set up the counters for a component, so the first record() doesn't allocate them.
+        :return: The name, for use with record().
+        """
+        if name not in self.components:
+            self.components[name] = array('i', [0, 0, 0, 0])
+        return name
+
+    def start(self):
+        return gc.mem_alloc()
+
+    def record(self, name, start):
+        """
+        Count a call of a component that began when gc.mem_alloc() was start.
+        """
+        used = gc.mem_alloc()
+        counters = self.components.get(name)
+        if counters is None:
+            counters = self.components[self.component(name)]
+        if used < start:
+            # the heap shrank, a collection ran during the call
+            counters[COLLECTED] += 1
+        else:
+            allocated = used - start
+            counters[ALLOC] += allocated
+            if allocated > counters[MAX]:
+                counters[MAX] = allocated
+        if used > counters[PEAK]:
+            counters[PEAK] = used
+        if self.heap - used < self.low:
+            self.low = self.heap - used
+
+    def collect(self):
+        """
+        Run gc.collect() and time it.
+        """
+        start = ticks_us()
+        gc.collect()
+        pause = ticks_diff(ticks_us(), start)
+        self.collections += 1
+        self.pause_total += pause
+        if pause > self.pause_max:
+            self.pause_max = pause
+
+    def idle(self, idle_ms):
+        """
+        Collect now if the policy is enabled and free heap is low.
+        :param idle_ms: Time until the next task is due.
+        :return: True if it collected.
+        """
+        if self.collect_below is None or idle_ms < self.min_idle_ms:
+            return False
+        if self.heap - gc.mem_alloc() >= self.collect_below:
+            return False
+        self.collect()
+        return True
+
+    def write(self, out):
+        """
+        Write the report as a JSON object into a PayloadBuffer.
+        """
+        out.write(b'{"heap":').write_int(self.heap).write(b',"low":').write_int(self.low)
+        out.write(b',"gc":{"n":').write_int(self.collections).write(b',"total":').write_int(self.pause_total)
+        out.write(b',"max":').write_int(self.pause_max)
+        out.write(b'},"components":{')
+        first = True
+        for name, counters in self.components.items():
+            if not first:
+                out.write(b',')
+            first = False
+            out.write(b'"').write(name.encode()).write(b'":{"peak":').write_int(counters[PEAK])
+            out.write(b',"alloc":').write_int(counters[ALLOC]).write(b',"max":').write_int(counters[MAX])
+            out.write(b',"gc":').write_int(counters[COLLECTED]).write(b'}')
+        return out.write(b'}}')
+
+    def clear(self):
+        self.low = self.heap - gc.mem_alloc()
+        self.collections = self.pause_total = self.pause_max = 0
+        for counters in self.components.values():
+            for i in range(len(counters)):
+                counters[i] = 0
+
+    def print(self):
+        print("heap {} bytes, lowest free {}, {} idle collections, {} us in total, longest {} us".format(
+            self.heap, self.low, self.collections, self.pause_total, self.pause_max))
+        print("{:<14} {:>8} {:>8} {:>8} {:>4}".format("component", "peak", "alloc", "max", "gc"))
+        for name, counters in self.components.items():
+            print("{:<14} {:>8} {:>8} {:>8} {:>4}".format(name, counters[PEAK], counters[ALLOC],
+                                                         counters[MAX], counters[COLLECTED]))
@@ -0,0 +1,292 @@
+"""
+Copyright (c) 2020, Digi International, Inc.
+Sample code released under MIT License.
+
+Persistent MQTT session with QoS 1 publishing on top of umqtt.simple.
+
+MQTTClient connects with a clean session and publishes at QoS 0 by
+default, so every reconnect subscribes to everything again and a message
+sent just before the cellular link dropped is lost. Its QoS 1 publish
+blocks until the broker acknowledges it, which stalls the main loop for a
+round trip per message.
+
+MQTTSession connects with clean_session=False, so the broker keeps the
+subscriptions and queues messages for them while the device is away; they
+are only sent again when the broker reports it has no session for us. QoS 1
+messages are written without waiting and kept until their PUBACK arrives,
+with at most `window` of them unacknowledged at a time. Whatever is still
+unacknowledged when the connection drops is sent again, flagged as a
+duplicate, after the next connect. Each slot of the window has a buffer
+the topic and payload are copied into, reused for every message, so
+publishing doesn't allocate; only a message too big for it is copied into
+a new bytes object.
+
+Every connect also times the TCP, TLS and MQTT handshake. Where the SSL
+layer takes a session in wrap_socket() and exposes the negotiated one on
+the socket, the TLS session of the last connection to each server is
+offered on the next, so a reconnect can skip the certificate exchange.
+The XBee ussl module doesn't, and there a full handshake is made and timed
+as before.
+
+Copy this file to the /flash/lib directory on the XBee Filesystem.
+"""
+
+from array import array
+from struct import pack_into
+from time import ticks_ms, ticks_us, ticks_diff
+
+PUBLISH_QOS1 = 0x32
+DUP = 0x08
+PUBACK = 0x40
+
+# TLS session of the last connection to each server, shared so a new MQTTClient can resume it too
+_tls_sessions = {}
+
+
+class MQTTSession:
+    def __init__(self, client, window=4, slot_size=1024, diagnostics=None):
+        """
+        :param client: umqtt.simple MQTTClient, its callback must be set before connect().
+        :param window: Most QoS 1 messages waiting for a PUBACK at once.
+        :param slot_size: Bytes of topic and payload each slot holds without allocating.
+        :param diagnostics: Optional Diagnostics to time connects, publishes and message checks in.
+        """
+        self.client = client
+        self.diagnostics = diagnostics
+        self.window = window
+        self.subscriptions = []
+        # per slot: pid of the QoS 1 message the broker hasn't acknowledged (0 when free), its topic
+        # and payload lengths, and the buffer they're in, or (topic, msg) for a message that didn't fit
+        self._pids = array('H', [0] * window)
+        self._topic_lengths = array('H', [0] * window)
+        self._msg_lengths = array('i', [0] * window)
+        self._buffers = [bytearray(slot_size) for _ in range(window)]
+        self._views = [memoryview(buffer) for buffer in self._buffers]
+        self._large = [None] * window
+        self.present = False
+        self.redelivered = 0
+        self._pid = 0
+        self._header = bytearray(5)
+        self._word = bytearray(2)
+        # handshake statistics, to see what resuming TLS sessions saves
+        self.resume_tls = client.ssl
+        self.handshakes = 0
+        self.resumed = 0
+        self.handshake_ms = 0
+        self.handshake_total_ms = 0
+        if self.resume_tls:
+            # MQTTClient's default ssl_params is shared between all clients
+            client.ssl_params = dict(client.ssl_params)
+
+    def subscribe(self, topic, qos=1):
+        """
+        Add a subscription, made on connect() whenever the broker has no session for us.
+        """
+        if (topic, qos) not in self.subscriptions:
+            self.subscriptions.append((topic, qos))
+
+    def connect(self):
+        """
+        Connect, resume the session and send the messages that were in flight again.
+        :return: True if the broker still had our session.
+        """
+        if self.client.sock is not None:
+            try:
+                self.client.sock.close()
+            except OSError:
+                pass
+        self.present = bool(self._handshake())
+        if not self.present:
+            for topic, qos in self.subscriptions:
+                self.client.subscribe(topic, qos)
+        # subscribing waits for its SUBACK and would drop a PUBACK, so this comes after
+        waiting = [slot for slot in range(self.window) if self._pids[slot]]
+        for slot in sorted(waiting, key=lambda slot: self._pids[slot]):
+            self._send(slot, DUP)
+            self.redelivered += 1
+        return self.present
+
+    def _handshake(self):
+        client = self.client
+        if self.resume_tls and client.server in _tls_sessions:
+            client.ssl_params["session"] = _tls_sessions[client.server]
+        start = ticks_ms()
+        try:
+            present = client.connect(clean_session=False)
+        except TypeError:
+            # wrap_socket() doesn't take a session, stop offering one
+            print("TLS session resumption not supported")
+            self.resume_tls = False
+            client.ssl_params.pop("session", None)
+            client.sock.close()
+            start = ticks_ms()
+            present = client.connect(clean_session=False)
+        except OSError:
+            # don't offer a session the server may have refused again
+            _tls_sessions.pop(client.server, None)
+            raise
+        finally:
+            client.ssl_params.pop("session", None)
+        self.handshake_ms = ticks_diff(ticks_ms(), start)
+        if self.diagnostics is not None:
+            self.diagnostics.record_us("mqtt_connect", self.handshake_ms * 1000)
+        self.handshakes += 1
+        self.handshake_total_ms += self.handshake_ms
+        resumed = False
+        if self.resume_tls:
+            resumed = getattr(client.sock, "session_reused", False)
+            session = getattr(client.sock, "session", None)
+            if session is None:
+                # nothing to resume with, don't look again
+                self.resume_tls = False
+            else:
+                _tls_sessions[client.server] = session
+        if resumed:
+            self.resumed += 1
+        print("MQTT connect took {} ms, {}".format(self.handshake_ms,
+                                                   "TLS session resumed" if resumed else "full handshake"))
+        return present
+
+    def print_stats(self):
+        print("handshakes: {}, TLS sessions resumed: {}, last: {} ms, average: {} ms".format(
+            self.handshakes, self.resumed, self.handshake_ms,
+            self.handshake_total_ms // self.handshakes if self.handshakes else 0))
+
+    def publish(self, topic, msg, qos=1):
+        """
+        Publish a message without waiting for the broker.
+        :param topic: Topic of the message, copied like msg.
+        :param msg: Payload, copied into a slot buffer so the caller can reuse its own. A str is encoded
+        first, which allocates.
+        :param qos: 0 or 1.
+        :return: True once the session has taken the message, False if the window is full.
+        """
+        if qos == 0:
+            self.client.publish(topic, msg)
+            return True
+        slot = self._free_slot()
+        if slot < 0:
+            # the acknowledgements may already be waiting to be read
+            self.check_msg()
+            slot = self._free_slot()
+            if slot < 0:
+                return False
+        if isinstance(topic, str):
+            topic = topic.encode()
+        if isinstance(msg, str):
+            msg = msg.encode()
+        self._pid = self._pid % 0xFFFF + 1
+        topic_length = len(topic)
+        msg_length = len(msg)
+        end = topic_length + msg_length
+        if end <= len(self._buffers[slot]):
+            view = self._views[slot]
+            view[:topic_length] = topic
+            view[topic_length:end] = msg
+        else:
+            self._large[slot] = (bytes(topic), bytes(msg))
+        self._topic_lengths[slot] = topic_length
+        self._msg_lengths[slot] = msg_length
+        self._pids[slot] = self._pid
+        start = ticks_us()
+        try:
+            self._send(slot, 0)
+        except OSError:
+            # not on the wire, the caller still owns it
+            self._release(slot)
+            raise
+        if self.diagnostics is not None:
+            self.diagnostics.record("mqtt_publish", start)
+        return True
+
+    def _free_slot(self):
+        for slot in range(self.window):
+            if not self._pids[slot]:
+                return slot
+        return -1
+
+    def _release(self, slot):
+        self._pids[slot] = 0
+        self._large[slot] = None
+
+    def _send(self, slot, flags):
+        topic_length = self._topic_lengths[slot]
+        msg_length = self._msg_lengths[slot]
+        sock = self.client.sock
+        header = self._header
+        header[0] = PUBLISH_QOS1 | flags
+        size = 2 + topic_length + 2 + msg_length
+        i = 1
+        while size > 0x7F:
+            header[i] = (size & 0x7F) | 0x80
+            size >>= 7
+            i += 1
+        header[i] = size
+        sock.write(header, i + 1)
+        pack_into("!H", self._word, 0, topic_length)
+        sock.write(self._word)
+        large = self._large[slot]
+        if large is None:
+            sock.write(self._buffers[slot], 0, topic_length)
+        else:
+            sock.write(large[0])
+        pack_into("!H", self._word, 0, self._pids[slot])
+        sock.write(self._word)
+        if large is None:
+            sock.write(self._buffers[slot], topic_length, msg_length)
+        else:
+            sock.write(large[1])
+
+    def _read_length(self):
+        length = 0
+        shift = 0
+        while True:
+            byte = self.client.sock.read(1)[0]
+            length |= (byte & 0x7F) << shift
+            if not byte & 0x80:
+                return length
+            shift += 7
+
+    def _handle(self, op):
+        # MQTTClient only reads the first byte of packets other than messages
+        length = self._read_length()
+        data = self.client.sock.read(length) if length else b""
+        if op == PUBACK:
+            pid = data[0] << 8 | data[1]
+            for slot in range(self.window):
+                if self._pids[slot] == pid:
+                    self._release(slot)
+                    break
+
+    def wait_msg(self):
+        """
+        Wait for the broker to send something and handle it, see check_msg().
+        """
+        op = self.client.wait_msg()
+        if op is not None:
+            self._handle(op)
+
+    def check_msg(self):
+        """
+        Handle what the broker has sent. Messages go to the client callback as with
+        MQTTClient.check_msg(), acknowledgements end the flight of their message.
+        """
+        start = ticks_us()
+        while True:
+            op = self.client.check_msg()
+            if op is None:
+                # nothing waiting, or a message or ping response that was handled
+                break
+            self._handle(op)
+        if self.diagnostics is not None:
+            self.diagnostics.record("mqtt_check", start)
+
+    def pending(self):
+        """
+        :return: Number of QoS 1 messages waiting for a PUBACK.
+        """
+        count = 0
+        for pid in self._pids:
+            if pid:
+                count += 1
+        return count
@@ -0,0 +1,81 @@
+"""
+Copyright (c) 2020, Digi International, Inc.
+Sample code released under MIT License.
+
+Night light detection from smoothed lumens readings.
+
+Comparing single raw readings against the on and off thresholds makes the
+night light flap when the light level sits near one of them, and every
+flip is a cloud update. NightLightDetector smooths the readings with an
+exponentially weighted moving average, applies the thresholds to that with
+hysteresis between them, and only switches once the smoothed level has
+stayed past the threshold for the dwell time. The average is kept in fixed
+point so a reading doesn't allocate a float.
+
+Copy this file to the /flash/lib directory on the XBee Filesystem.
+"""
+
+from time import ticks_ms, ticks_diff
+
+# fractional bits of the fixed point average
+SCALE = 8
+
+
+class NightLightDetector:
+    def __init__(self, on_below=20, off_above=40, dwell_ms=5000, smoothing=2):
+        """
+        :param on_below: The night light turns on when the smoothed level falls below this.
+        :param off_above: And off when it rises above this.
+        :param dwell_ms: How long the level must stay past a threshold before the state changes.
+        :param smoothing: Each reading moves the average 1/2**smoothing of the way, 0 for no smoothing.
+        """
+        self.on_below = on_below
+        self.off_above = off_above
+        self.dwell_ms = dwell_ms
+        self.smoothing = smoothing
+        self.state = False
+        self.changes = 0
+        self._level = None
+        self._crossed_at = None
+
+    def add(self, lumens):
+        """
+        Take a new reading, only call this once per reading.
+        """
+        if self._level is None:
+            self._level = lumens << SCALE
+        else:
+            self._level += ((lumens << SCALE) - self._level) >> self.smoothing
+
+    def level(self):
+        """
+        :return: The smoothed light level, None before the first reading.
+        """
+        return None if self._level is None else self._level >> SCALE
+
+    def update(self, now=None):
+        """
+        Run the state machine.
+        :param now: ticks_ms() timestamp, for replaying recorded readings.
+        :return: True if the night light state changed.
+        """
+        if self._level is None:
+            return False
+        level = self._level >> SCALE
+        if self.state:
+            crossed = level > self.off_above
+        else:
+            crossed = level < self.on_below
+        if not crossed:
+            self._crossed_at = None
+            return False
+        if now is None:
+            now = ticks_ms()
+        if self._crossed_at is None:
+            self._crossed_at = now
+        if ticks_diff(now, self._crossed_at) < self.dwell_ms:
+            return False
+        self.state = not self.state
+        self.changes += 1
+        self._crossed_at = None
+        return True
@@ -0,0 +1,158 @@
+"""
+Copyright (c) 2020, Digi International, Inc.
+Sample code released under MIT License.
+
+Flash-backed store-and-forward queue.
+
+When the cellular link or the cloud connection is down, readings that
+could not be published are appended to Outbox instead of being dropped,
+and replayed oldest first once the connection is back. The log is two
+append-only segment files of fixed-size binary records that are used in
+turn: when the current segment fills up the other one is truncated and
+written next, so the oldest records are overwritten first and writes are
+spread over both files. Only the sequence number of the next record to
+send is ever rewritten, once per replay batch.
+
+A replay with defer=True hands records on without removing them, for a
+sender that uploads asynchronously; they stay on flash until acknowledge()
+is called once the upload has completed, and are replayed again after a
+reset if it never does.
+
+Copy this file to the /flash/lib directory on the XBee Filesystem.
+"""
+
+from struct import pack, unpack, calcsize
+from time import time
+
+# sequence number, capture time, light state, night light state, lumens
+RECORD_FORMAT = "<IIBBi"
+RECORD_SIZE = calcsize(RECORD_FORMAT)
+
+
+class Outbox:
+    def __init__(self, path="/flash/outbox", segment_records=64):
+        """
+        :param path: Prefix of the files used on flash.
+        :param segment_records: Records per segment, the queue holds up to twice this many.
+        """
+        self.segments = (path + "0.bin", path + "1.bin")
+        self.tail_path = path + ".tail"
+        self.segment_records = segment_records
+        self.current = 0
+        self.count = 0
+        self.head = 1
+        self.tail = self._load_tail()
+        for i, segment in enumerate(self.segments):
+            records = 0
+            for record in self._records(segment):
+                records += 1
+                if record[0] >= self.head:
+                    self.head = record[0] + 1
+                    self.current = i
+            if i == self.current:
+                self.count = records
+        # records older than what the segments can still hold are gone
+        self.tail = min(max(self.tail, self.head - 2 * segment_records, 1), self.head)
+        # next record to hand on, ahead of tail while a deferred replay waits for acknowledge()
+        self.cursor = self.tail
+
+    def _load_tail(self):
+        try:
+            with open(self.tail_path, "rb") as f:
+                return unpack("<I", f.read(4))[0]
+        except (OSError, ValueError):
+            return 1
+
+    def _save_tail(self):
+        with open(self.tail_path, "wb") as f:
+            f.write(pack("<I", self.tail))
+
+    @staticmethod
+    def _records(segment):
+        try:
+            with open(segment, "rb") as f:
+                while True:
+                    data = f.read(RECORD_SIZE)
+                    if len(data) < RECORD_SIZE:
+                        # end of file or a record torn by a reset
+                        return
+                    yield unpack(RECORD_FORMAT, data)
+        except OSError:
+            return
+
+    def pending(self):
+        return self.head - self.tail
+
+    def append(self, light, nightlight, lumens):
+        mode = "ab"
+        if self.count == self.segment_records:
+            self.current = 1 - self.current
+            self.count = 0
+            mode = "wb"
+            # the records in the segment being reused are lost
+            self.tail = max(self.tail, self.head - self.segment_records)
+            self.cursor = max(self.cursor, self.tail)
+        with open(self.segments[self.current], mode) as f:
+            f.write(pack(RECORD_FORMAT, self.head, int(time()), light, nightlight, lumens))
+        self.head += 1
+        self.count += 1
+
+    def records(self):
+        """
+        Iterate over the queued records oldest first, without removing them.
+        :return: Generator of (seq, timestamp, light, nightlight, lumens), close it if stopping part way.
+        """
+        # the segment not being written holds the older records
+        for segment in (self.segments[1 - self.current], self.segments[self.current]):
+            records = self._records(segment)
+            try:
+                for record in records:
+                    if record[0] >= self.tail:
+                        yield record
+            finally:
+                # closes the segment file if we stopped part way
+                records.close()
+
+    def replay(self, send, limit=10, defer=False):
+        """
+        Send up to limit queued records, oldest first, stopping at the first one that fails.
+        :param send: Called as send(timestamp, light, nightlight, lumens), returns True once sent.
+        :param limit: Most records sent per call, so a backlog doesn't flood the link.
+        :param defer: Keep the records queued until acknowledge(), they aren't handed to send again meanwhile.
+        :return: Number of records sent.
+        """
+        start = max(self.cursor, self.tail)
+        if start >= self.head:
+            return 0
+        sent = 0
+        records = self.records()
+        try:
+            for seq, timestamp, light, nightlight, lumens in records:
+                if seq < start:
+                    continue
+                if sent == limit or not send(timestamp, light, nightlight, lumens):
+                    break
+                self.cursor = seq + 1
+                if not defer:
+                    self.tail = seq + 1
+                sent += 1
+            return sent
+        finally:
+            records.close()
+            if sent and not defer:
+                self._save_tail()
+
+    def rewind(self):
+        """
+        Hand the records of a deferred replay on again, their delivery failed.
+        """
+        self.cursor = self.tail
+
+    def acknowledge(self, cursor):
+        """
+        Remove the records a deferred replay handed on before cursor was read, once they have been delivered.
+        :param cursor: The value of self.cursor when the delivery started.
+        """
+        if cursor > self.tail:
+            self.tail = min(cursor, self.head)
+            self._save_tail()
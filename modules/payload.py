@@ -0,0 +1,82 @@
+"""
+Copyright (c) 2020, Digi International, Inc.
+Sample code released under MIT License.
+
+Allocation-free payload encoding for the publish path.
+
+Building a dict per publish and running it through ujson.dumps leaves a
+trail of short-lived objects on the heap, and on MicroPython that trail
+ends in a GC pause in the middle of the loop. PayloadBuffer encodes the
+smart switch JSON payloads into one bytearray allocated up front, using
+fixed byte templates for the light, night light and lumens fields and
+writing integers digit by digit. publish() is handed a memoryview of the
+encoded bytes, so no copy is made either.
+
+Copy this file to the /flash/lib directory on the XBee Filesystem.
+"""
+
+LIGHT_STATE = b'"light_state":'
+NIGHT_LIGHT_STATE = b'"night_light_state":'
+LUMENS = b'"lumens":'
+ON = b'"on"'
+OFF = b'"off"'
+
+
+class PayloadBuffer:
+    def __init__(self, size=128):
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.length = 0
+
+    def reset(self):
+        self.length = 0
+        return self
+
+    def write(self, data):
+        end = self.length + len(data)
+        self.view[self.length:end] = data
+        self.length = end
+        return self
+
+    def write_int(self, value):
+        if value < 0:
+            self.buf[self.length] = 0x2D  # '-'
+            self.length += 1
+            value = -value
+        start = self.length
+        while True:
+            self.buf[self.length] = 0x30 + value % 10
+            self.length += 1
+            value //= 10
+            if not value:
+                break
+        # the digits went in least significant first, put them the right way round
+        end = self.length - 1
+        while start < end:
+            self.buf[start], self.buf[end] = self.buf[end], self.buf[start]
+            start += 1
+            end -= 1
+        return self
+
+    def _name(self, name, first):
+        if not first:
+            self.write(b',')
+        return self.write(name)
+
+    def field_on_off(self, name, value, first=False):
+        """
+        Append '"name":"on"' or '"name":"off"' to the payload.
+        :param name: One of the field templates, e.g. LIGHT_STATE.
+        :param value: Truth value of the field.
+        :param first: Leave out the separating comma.
+        """
+        return self._name(name, first).write(ON if value else OFF)
+
+    def field_int(self, name, value, first=False):
+        """
+        Append '"name":value' to the payload, see field_on_off().
+        """
+        return self._name(name, first).write_int(value)
+
+    def payload(self):
+        return self.view[:self.length]
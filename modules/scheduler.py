@@ -0,0 +1,135 @@
+"""
+Copyright (c) 2020, Digi International, Inc.
+Sample code released under MIT License.
+
+Cooperative scheduler.
+
+Replaces a busy-wait main loop with periodic tasks. Each task has its own
+period and a deadline, the time it may start late before it counts as
+missed. When several tasks are due the one with the earliest deadline runs
+first, and between tasks the scheduler sleeps until the next one is due
+instead of spinning. Due times advance by whole periods from the previous
+due time, so lateness doesn't accumulate into drift; a task that falls a
+full period behind skips the runs it missed rather than bursting. Tasks
+are plain functions and must return promptly; a task that blocks delays
+the others.
+
+Copy this file to the /flash/lib directory on the XBee Filesystem.
+"""
+
+from time import ticks_ms, ticks_us, ticks_diff, ticks_add, sleep_ms
+from sys import print_exception
+
+
+class Task:
+    def __init__(self, callback, period_ms, deadline_ms, name):
+        self.callback = callback
+        self.period_ms = period_ms
+        self.deadline_ms = deadline_ms
+        self.name = name
+        self.due = ticks_ms()
+        self.runs = 0
+        self.missed = 0
+
+    def latest_start(self):
+        return ticks_add(self.due, self.deadline_ms)
+
+
+class Scheduler:
+    def __init__(self, diagnostics=None, memory=None):
+        """
+        :param diagnostics: Optional Diagnostics to time every task run in, as "task.<name>".
+        :param memory: Optional MemoryProfiler to sample the heap around every task run and collect in idle time.
+        """
+        self.tasks = []
+        self.diagnostics = diagnostics
+        self.memory = memory
+
+    def add(self, callback, period_ms, deadline_ms=None, name=None):
+        """
+        Run callback every period_ms.
+        :param callback: Function taking no arguments.
+        :param period_ms: Time between runs in milliseconds.
+        :param deadline_ms: How late the task may start, defaults to the period.
+        :param name: Name used in debug output, defaults to the function name.
+        :return: The Task, its period can be changed at run time.
+        """
+        if deadline_ms is None:
+            deadline_ms = period_ms
+        task = Task(callback, period_ms, deadline_ms, name or getattr(callback, "__name__", "task"))
+        if self.diagnostics is not None:
+            task.operation = self.diagnostics.operation("task." + task.name)
+        if self.memory is not None:
+            self.memory.component(task.name)
+        self.tasks.append(task)
+        return task
+
+    def run_once(self):
+        """
+        Run every task that is due, earliest deadline first.
+        :return: Milliseconds until the next task is due.
+        """
+        now = ticks_ms()
+        while True:
+            # picked in place rather than from a sorted list, so a pass doesn't allocate
+            task = None
+            for t in self.tasks:
+                if ticks_diff(now, t.due) >= 0 and (task is None or
+                                                    ticks_diff(t.latest_start(), task.latest_start()) < 0):
+                    task = t
+            if task is None:
+                break
+            start = ticks_ms()
+            if ticks_diff(start, task.latest_start()) > 0:
+                task.missed += 1
+            if self.memory is not None:
+                start_alloc = self.memory.start()
+            start_us = ticks_us()
+            try:
+                task.callback()
+            except OSError as e:
+                # provide debug info, but keep going
+                print("task {} failed".format(task.name))
+                print_exception(e)
+            if self.diagnostics is not None:
+                self.diagnostics.record(task.operation, start_us)
+            if self.memory is not None:
+                self.memory.record(task.name, start_alloc)
+            task.runs += 1
+            # advance from the due time, not the start time, so the rate doesn't drift
+            task.due = ticks_add(task.due, task.period_ms)
+            if ticks_diff(task.due, ticks_ms()) < 0:
+                task.due = ticks_add(start, task.period_ms)
+        return self.next_due()
+
+    def next_due(self):
+        """
+        :return: Milliseconds until the next task is due.
+        """
+        now = ticks_ms()
+        wait = None
+        for task in self.tasks:
+            left = ticks_diff(task.due, now)
+            if wait is None or left < wait:
+                wait = left
+        return wait
+
+    def task(self, name):
+        for task in self.tasks:
+            if task.name == name:
+                return task
+        return None
+
+    def run(self):
+        while True:
+            wait = self.run_once()
+            if wait > 0 and self.memory is not None and self.memory.idle(wait):
+                # the collection used part of the idle time
+                wait = self.next_due()
+            if wait > 0:
+                sleep_ms(wait)
+
+    def print(self):
+        for task in self.tasks:
+            print("{:<10} period {:>6} ms  runs {:>8}  missed {:>6}".format(task.name, task.period_ms,
+                                                                          task.runs, task.missed))
@@ -0,0 +1,108 @@
+"""
+Copyright (c) 2020, Digi International, Inc.
+Sample code released under MIT License.
+
+Telemetry batching.
+
+Every MQTT publish over cellular costs a TLS record and an MQTT header on
+top of the payload, which dwarfs a single {"lumens": n}. TelemetryBatch
+collects timestamped samples in preallocated arrays and turns them into
+one compact message:
+
+    {"t": 1589212800, "dt": [0, 1000, 2000], "lumens": [52, 51, 53]}
+
+where "t" is the Unix time of the first sample in seconds and "dt" the
+offset of each sample from it in milliseconds. Samples replayed from the
+outbox are added with the time they were captured at, to the second, and
+may come before "t" with a negative offset. The owner flushes the batch
+when it is full, when the oldest sample is too old, or at once when the
+state it reports has changed. The message is encoded into a PayloadBuffer
+sized for a full batch, so flushing doesn't allocate.
+
+Copy this file to the /flash/lib directory on the XBee Filesystem.
+"""
+
+from array import array
+from time import time, ticks_ms, ticks_diff
+from payload import PayloadBuffer, LUMENS
+
+# Seconds between the Unix epoch and the MicroPython epoch of 2000-01-01
+EPOCH_OFFSET = 946684800
+
+
+class TelemetryBatch:
+    def __init__(self, name=LUMENS, size=30, max_age_ms=60000):
+        """
+        :param name: Field template for the sample values in the payload.
+        :param size: Samples per message.
+        :param max_age_ms: Longest time a sample may wait before the batch is due.
+        """
+        self.name = name
+        self.max_age_ms = max_age_ms
+        self.offsets = array('i', [0] * size)
+        self.values = array('i', [0] * size)
+        # room for the "t" field and two arrays of 11 digit numbers
+        self.out = PayloadBuffer(48 + 24 * size)
+        self.count = 0
+        self.dropped = 0
+        self._start_time = 0
+        self._start_ticks = 0
+        # offset of _start_ticks from "t", not 0 when the first sample was a replayed one
+        self._start_offset = 0
+
+    def add(self, value, timestamp=None):
+        """
+        :param value: The sample.
+        :param timestamp: Capture time in seconds since the MicroPython epoch, as time(), now if None.
+        :return: False if the batch is full and the sample was dropped.
+        """
+        if self.count == len(self.values):
+            # nobody has flushed us, keep the older samples
+            self.dropped += 1
+            return False
+        now = ticks_ms()
+        if self.count == 0:
+            current = int(time())
+            self._start_time = (current if timestamp is None else timestamp) + EPOCH_OFFSET
+            self._start_ticks = now
+            self._start_offset = 0 if timestamp is None else (current - timestamp) * 1000
+        if timestamp is None:
+            self.offsets[self.count] = self._start_offset + ticks_diff(now, self._start_ticks)
+        else:
+            self.offsets[self.count] = (timestamp + EPOCH_OFFSET - self._start_time) * 1000
+        self.values[self.count] = value
+        self.count += 1
+        return True
+
+    def pop(self):
+        """
+        Remove the newest sample, for a caller that keeps it elsewhere after a failed flush.
+        """
+        if self.count:
+            self.count -= 1
+
+    def due(self):
+        """
+        :return: True when the batch is full or its oldest sample has waited max_age_ms.
+        """
+        if self.count == 0:
+            return False
+        return self.count == len(self.values) or ticks_diff(ticks_ms(), self._start_ticks) >= self.max_age_ms
+
+    def _array(self, name, values):
+        self.out.write(name).write(b'[')
+        for i in range(self.count):
+            if i:
+                self.out.write(b',')
+            self.out.write_int(values[i])
+        self.out.write(b']')
+
+    def payload(self):
+        self.out.reset().write(b'{"t":').write_int(self._start_time).write(b',')
+        self._array(b'"dt":', self.offsets)
+        self.out.write(b',')
+        self._array(self.name, self.values)
+        return self.out.write(b'}').payload()
+
+    def clear(self):
+        self.count = 0
@@ -6,18 +6,40 @@ Instructions:
 
  - Ensure that the umqtt/simple.py module is in the /flash/lib directory
    on the XBee Filesystem
+ - Copy the following files from modules/ to the /flash/lib directory on
+   the XBee Filesystem: gatt_cache.py, ble_helper.py, ble_scan.py,
+   scheduler.py, button.py, outbox.py, backoff.py, device_requests.py,
+   deadband.py, nightlight.py, diagnostics.py, memory.py, payload.py.
  - Push the reset or button left of the USB connector on the Silicon Labs
    Thundersense 2 to send advertisements for 30 seconds.
  - Make sure your XBee has been added to your Digi Remote Manager
    account.
+ - Send device requests from Remote Manager to one of these targets:
+   light (the default): a body of "on" or "off" sets the light.
+   state: answers with the current state as JSON.
+   config: "task=period_ms" lines change task periods, e.g. "ble=2000".
+   history: answers with the readings queued on flash as CSV.
 
 """
 
-from time import time
 from network import Cellular
 from digi import cloud
+from array import array
+from time import time, ticks_ms, ticks_diff, ticks_add
 from struct import pack, unpack
 from digi import ble
+from gatt_cache import GATTCache
+from ble_helper import enable_notifications, WriteOnChange
+from ble_scan import BLEScanner
+from nightlight import NightLightDetector
+from scheduler import Scheduler
+from diagnostics import Diagnostics
+from memory import MemoryProfiler
+from button import DebouncedButton
+from outbox import Outbox
+from deadband import DeadbandFilter
+from backoff import Backoff
+from device_requests import RequestRouter
 from machine import Pin
 import xbee
 from sys import print_exception
@@ -29,57 +51,110 @@ io_characteristic_uuid = 0x2A56
 env_service_uuid = 0x181a
 lumens_characteristic_uuid = 'c8546913-bfd9-45eb-8dde-9f8754f4a32e'
 
+# Characteristics used by the smart switch: name -> (service, characteristic, index)
+characteristic_specs = {
+    "leds": (io_service_uuid, io_characteristic_uuid, 1),
+    "lumens": (env_service_uuid, lumens_characteristic_uuid, 0),
+}
+
+# Set to True to have the board push lumens readings instead of polling them
+lumens_notify = False
+
+# The night light turns on below the first and off above the second smoothed lumens level,
+# once the level has stayed past the threshold for nightlight_dwell_ms
+nightlight_thresholds = (20, 40)
+nightlight_dwell_ms = 5000
+
+# Task periods in milliseconds, lower means less latency but more power
+periods_ms = {
+    "state": 20,  # button and night light checks
+    "connect": 500,  # BLE connection attempts
+    "ble": 1000,  # BLE sensor reads and LED refresh
+    "publish": 1000,  # pending changes into the upload batch
+    "upload": 1000,  # DataPoints upload of the batch and its progress
+    "telemetry": 10000,  # lumens samples between changes
+    "requests": 1000,  # Remote Manager device requests
+    "replay": 5000,  # readings queued on flash during an outage
+    "diagnostics": 300000,  # operation counts and latencies published
+}
+
+# Samples are uploaded together once the oldest has waited this long, or sooner after a change
+batch_window_ms = 60000
+change_settle_ms = 2000
+
+# Lumens readings within this many counts, or this fraction, of the last one published are
+# only summarized, with a min/max/mean/count summary at the end of each window
+lumens_deadband = 5
+lumens_deadband_ratio = 0.1
+lumens_window_ms = 300000
+
+# Run gc.collect() between tasks once free heap falls below this many bytes, None leaves collections to the
+# allocator, which runs them whenever an allocation fails, possibly in the middle of a publish
+gc_collect_below = None
+
 ble.active(True)
+# times the blocking operations and samples the heap per task, see periods_ms["diagnostics"]
+memory = MemoryProfiler(collect_below=gc_collect_below)
+diagnostics = Diagnostics(size=3072, memory=memory)
 cell_conn = Cellular()
 
 
 class BLESmartSwitch:
-    @staticmethod
-    def _find_thunderboard():
-        scanner = ble.gap_scan(200, interval_us=2500, window_us=2500)
-        for adv in scanner:
-            if b"Thunder Sense" in adv['payload']:
-                return adv['address']
-        return None
-
-    def __init__(self):
+    def __init__(self, notify=lumens_notify):
         self.address = None
         self.conn = None
         self.lumens = 100
         self.leds_characteristic = None
         self.lumens_characteristic = None
         self.light_state = [0, 0]
-
-    def get_characteristics_from_uuids(self, service_uuid, characteristic_uuid):
-        services = list(self.conn.gattc_services(service_uuid))
-        if len(services):
-            # Assume that there is only one service per UUID, take the first one
-            my_service = services[0]
-            characteristics = list(self.conn.gattc_characteristics(my_service, characteristic_uuid))
-            return characteristics
-        # Couldn't find specified characteristic, return an empy list
-        return []
+        self.scanner = BLEScanner(name=b"Thunder Sense")
+        self.gatt_cache = GATTCache()
+        # polling is used as a fallback when the board can't notify
+        self.notify = notify
+        self.notifying = False
+        # only writes the LEDs when light_state changes
+        self.leds = WriteOnChange()
+        # smoothed, so noise around a threshold doesn't toggle the night light
+        self.night_light = NightLightDetector(nightlight_thresholds[0], nightlight_thresholds[1], nightlight_dwell_ms)
 
     def is_connected(self):
         return self.conn is not None
 
     def connect(self):
         if self.address is None:
-            self.address = self._find_thunderboard()
+            start = diagnostics.start()
+            self.address = self.scanner.find()
+            diagnostics.record("ble_scan", start)
             if self.address:
                  print("Found thunderboard : {}".format(self.address))
         if self.conn is None:
             if self.address is not None:
                 try:
                     print("Attempting connection to: {}".format(self.address))
+                    start = diagnostics.start()
                     self.conn = ble.gap_connect(ble.ADDR_TYPE_PUBLIC, self.address)
-                    self.leds_characteristic = self.get_characteristics_from_uuids(io_service_uuid,
-                                                                                   io_characteristic_uuid)[1]
-                    self.lumens_characteristic = self.get_characteristics_from_uuids(env_service_uuid,
-                                                                                     lumens_characteristic_uuid)[0]
+                    # skips discovery when the handles for this board are already on flash
+                    characteristics = self.gatt_cache.resolve(self.conn, self.address, characteristic_specs)
+                    self.leds_characteristic = characteristics["leds"]
+                    self.lumens_characteristic = characteristics["lumens"]
+                    self.leds.attach(self.conn, self.leds_characteristic)
+                    self.scanner.remember(self.address)
+                    if self.notify:
+                        self.notifying = enable_notifications(self.conn, self.lumens_characteristic,
+                                                              self._lumens_received)
+                    diagnostics.record("ble_connect", start)
                     print("connected")
                 except OSError:
+                    diagnostics.record("ble_connect_failed", start)
                     self.conn = None
+                    self.notifying = False
+                    # an address remembered from a previous boot may be stale, scan next time
+                    if self.scanner.directed:
+                        self.address = None
+
+    def _lumens_received(self, data):
+        self.lumens = int(unpack('<I', data)[0]/100)
+        self.night_light.add(self.lumens)
 
     def get_lumens(self):
         return self.lumens
@@ -94,22 +169,35 @@ class BLESmartSwitch:
         self.light_state[0] = value
 
     def update_nightlight(self):
-        prev_light_state = self.light_state[1]
-        if self.lumens < 20:
-            self.light_state[1] = True
-        if self.lumens > 40:
-            self.light_state[1] = False
-        return prev_light_state != self.light_state[1]
+        if self.night_light.update():
+            self.light_state[1] = self.night_light.state
+            return True
+        return False
+
+    def sync_leds(self):
+        if self.conn is not None:
+            try:
+                self.leds.set(pack("b", self.light_state[0] | (self.light_state[1] << 2)))
+                writes = self.leds.writes
+                start = diagnostics.start()
+                self.leds.sync()
+                if self.leds.writes != writes:
+                    diagnostics.record("led_write", start)
+            except OSError:
+                self.conn = None
+                self.notifying = False
 
     def update(self):
+        self.sync_leds()
         if self.conn is not None:
             try:
-                led_value = pack("b", self.light_state[0] | (self.light_state[1] << 2))
-                self.conn.gattc_write_characteristic(self.leds_characteristic, led_value)
-                self.lumens = self.conn.gattc_read_characteristic(self.lumens_characteristic)
-                self.lumens = int(unpack('<I', self.lumens)[0]/100)
+                if not self.notifying:
+                    start = diagnostics.start()
+                    self._lumens_received(self.conn.gattc_read_characteristic(self.lumens_characteristic))
+                    diagnostics.record("gatt_read", start)
             except OSError:
                 self.conn = None
+                self.notifying = False
 
 
 def check_cellular():
@@ -117,13 +205,45 @@ def check_cellular():
 
 
 class DigiCloud:
-    def __init__(self):
+    def __init__(self, outbox=None, size=20, window_ms=batch_window_ms, settle_ms=change_settle_ms):
+        """
+        :param outbox: Outbox the changed states are replayed from, acknowledged once an upload completes.
+        :param size: Samples per upload, each is three data points.
+        :param window_ms: Longest time a sample waits for the upload.
+        :param settle_ms: Time after a change before the upload, so quick changes go out together.
+        """
         # connect to Digi Remote Manager over TCP
         xbee.atcmd("DO", 1)
         xbee.atcmd("MO", 7)
+        # upload in progress and the number of samples in it
         self.data = None
-        self.body = b""
+        self.sending = 0
         self.connected = True
+        # outbox records handed on before the upload in progress started are in it
+        self.outbox = outbox
+        self.sending_cursor = None
+        # device requests are answered by the handler for their target
+        self.router = RequestRouter()
+        # spaces out sends while Remote Manager can't be reached
+        self.backoff = Backoff()
+        # samples waiting for upload: capture time, light, night light and lumens
+        self.times = array('i', [0] * size)
+        self.lights = bytearray(size)
+        self.nightlights = bytearray(size)
+        self.lumens = array('i', [0] * size)
+        self.count = 0
+        self.window_ms = window_ms
+        self.settle_ms = settle_ms
+        self.batches = 0
+        self._due_at = None
+        # lumens summary waiting for upload, the number added so far, and which one the upload in progress carries
+        self.summary = array('i', [0, 0, 0, 0])
+        self.has_summary = False
+        self.summaries = 0
+        self.sending_summary = 0
+        # Diagnostics snapshot waiting for upload, and the one the upload in progress carries
+        self.report = None
+        self.sending_report = None
 
     def is_connected(self):
         return self.connected
@@ -142,112 +262,276 @@ class DigiCloud:
         else:
             return 'off'
 
-    def update(self, light, nightlight, lumens):
+    def _add(self, timestamp, light, nightlight, lumens, settle):
+        if self.count == len(self.lumens):
+            return False
+        i = self.count
+        self.times[i] = timestamp
+        self.lights[i] = bool(light)
+        self.nightlights[i] = bool(nightlight)
+        self.lumens[i] = lumens
+        self.count += 1
+        due_at = ticks_add(ticks_ms(), self.settle_ms if settle else self.window_ms)
+        if self._due_at is None or ticks_diff(due_at, self._due_at) < 0:
+            self._due_at = due_at
+        return True
+
+    def sample(self, light, nightlight, lumens):
+        """
+        Add a periodic sample to the batch.
+        :return: False if the batch is full.
+        """
+        return self._add(int(time()), light, nightlight, lumens, False)
+
+    def add_summary(self, readings):
+        """
+        Add the window summary of a DeadbandFilter to the batch, replacing one not yet uploaded.
+        """
+        self.summary[0] = readings.stats[0]
+        self.summary[1] = readings.stats[1]
+        self.summary[2] = readings.mean()
+        self.summary[3] = readings.stats[3]
+        self.has_summary = True
+        self.summaries += 1
+        due_at = ticks_add(ticks_ms(), self.window_ms)
+        if self._due_at is None or ticks_diff(due_at, self._due_at) < 0:
+            self._due_at = due_at
+
+    def add_diagnostics(self, report):
+        """
+        Add a Diagnostics snapshot to the batch as the "diagnostics" data stream, replacing one not yet uploaded.
+        """
+        self.report = bytes(report.payload()).decode()
+        due_at = ticks_add(ticks_ms(), self.window_ms)
+        if self._due_at is None or ticks_diff(due_at, self._due_at) < 0:
+            self._due_at = due_at
+
+    def update(self, light, nightlight, lumens, timestamp=None):
+        """
+        Add a changed state to the batch, it is uploaded within settle_ms.
+        :param timestamp: Capture time in seconds, now if None.
+        :return: False if the batch is full.
+        """
         print("update")
-        print(self.data)
-        if self.data is None:
-            try:
-                print("Sending data points")
-                self.data = cloud.DataPoints()
-                print("posting states: ", self._get_on_off(light), self._get_on_off(nightlight), lumens)
-                self.data.add("light_state", self._get_on_off(light))
-                self.data.add("night_light_state", self._get_on_off(nightlight))
-                self.data.add("lumens", lumens)
-                self.data.send()
-                if self.data.status() == cloud.SUCCESS:
-                    print("Send successful")
-                    self.data = None
-                    return True
-                # error try again next time
-                elif self.data.status() < 0:
-                    print("Send failed")
-                    self.data = None
-            # Handles if lose connectivity or our connection
-            except OSError as e:
-                print_exception(e)
+        print("posting states: ", self._get_on_off(light), self._get_on_off(nightlight), lumens)
+        return self._add(int(time()) if timestamp is None else timestamp, light, nightlight, lumens, True)
+
+    def _sent(self):
+        # samples added while the upload was in progress move to the front
+        for i in range(self.count - self.sending):
+            j = i + self.sending
+            self.times[i] = self.times[j]
+            self.lights[i] = self.lights[j]
+            self.nightlights[i] = self.nightlights[j]
+            self.lumens[i] = self.lumens[j]
+        self.count -= self.sending
+        self.sending = 0
+        if self.sending_cursor is not None:
+            self.outbox.acknowledge(self.sending_cursor)
+            self.sending_cursor = None
+        # a summary added while the upload was in progress still has to go
+        if self.sending_summary == self.summaries:
+            self.has_summary = False
+        self.sending_summary = 0
+        # unless add_diagnostics replaced it while the upload was in progress
+        if self.report is self.sending_report:
+            self.report = None
+        self.sending_report = None
+        waiting = self.count or self.has_summary or self.report is not None
+        self._due_at = ticks_add(ticks_ms(), self.settle_ms) if waiting else None
+
+    def upload(self):
+        """
+        Check on the upload in progress, or start one if the batch is due. Never waits for Remote Manager.
+        :return: True if an upload completed.
+        """
+        if self.data is not None:
+            status = self.data.status()
+            if status == cloud.SUCCESS:
+                print("Send successful,", self.sending, "samples")
                 self.data = None
+                self._sent()
+                self.backoff.succeeded()
+                return True
+            # error try again next time
+            elif status < 0:
+                print("Send failed")
+                self.data = None
+                self.sending = 0
+                self.sending_cursor = None
+                self.backoff.failed()
+            return False
+        if self._due_at is None or ticks_diff(ticks_ms(), self._due_at) < 0:
+            return False
+        if not self.backoff.ready(check_cellular()):
+            return False
+        try:
+            print("Sending data points")
+            self.data = cloud.DataPoints()
+            for i in range(self.count):
+                timestamp = self.times[i]
+                self.data.add("light_state", self._get_on_off(self.lights[i]), timestamp=timestamp)
+                self.data.add("night_light_state", self._get_on_off(self.nightlights[i]), timestamp=timestamp)
+                self.data.add("lumens", self.lumens[i], timestamp=timestamp)
+            if self.has_summary:
+                for i, stream in enumerate(("lumens_min", "lumens_max", "lumens_mean", "lumens_count")):
+                    self.data.add(stream, self.summary[i])
+            if self.report is not None:
+                self.data.add("diagnostics", self.report)
+            start = diagnostics.start()
+            self.data.send()
+            diagnostics.record("drm_send", start)
+            self.sending = self.count
+            if self.outbox is not None:
+                self.sending_cursor = self.outbox.cursor
+            self.sending_summary = self.summaries if self.has_summary else 0
+            self.sending_report = self.report
+            self.batches += 1
+        # Handles if lose connectivity or our connection
+        except OSError as e:
+            print_exception(e)
+            self.data = None
+            self.backoff.failed()
         return False
 
     def check_update(self):
         # do we already have a pending request
-        device_request = cloud.device_request_receive()
-        if device_request is not None:
-            print("got device request")
-            self.body = device_request.read().strip()
-            if self.body == b"on" or self.body == b"off":
-                response = "OK"
-            else:
-                response = "ERROR"
-            print("request status: {}".format(response))
-            device_request.write(response)
-            device_request.close()
+        start = diagnostics.start()
+        if self.router.check():
+            diagnostics.record("device_request", start)
             return True
         return False
 
-    def get_value(self):
-        return self.body
 
-
-def update_cloud(remote_mgr, bulbs):
+def update_cloud(remote_mgr, bulbs, outbox):
     print("update cloud")
-    if check_cellular():
-        return remote_mgr.update(bulbs.get_light(), bulbs.get_night_light(), bulbs.get_lumens())
-    return False
+    # the reading stays on flash until an upload carrying it has completed, and goes into the batch from there
+    outbox.append(bulbs.get_light(), bulbs.get_night_light(), bulbs.get_lumens())
+    replay_outbox(remote_mgr, outbox)
+    return True
+
+
+def replay_outbox(remote_mgr, outbox):
+    # rate limited by the replay period and batch size so a backlog doesn't flood the link
+    if outbox.pending() and check_cellular():
+        # the samples keep the time they were captured at
+        outbox.replay(lambda timestamp, light, nightlight, lumens: remote_mgr.update(light, nightlight, lumens,
+                                                                                     timestamp), defer=True)
 
 
 class Button:
     def __init__(self):
-        self.button = Pin.board.D1
-        self.button.mode(Pin.IN)
-        self.button.pull(Pin.PULL_UP)
-        self.state = [1, 1]
+        self.button = DebouncedButton(Pin.board.D1)
 
     def check_button(self, bulbs):
-        # set the previous state
-        self.state[0] = self.state[1]
-        # read the current button state
-        self.state[1] = self.button.value()
-        # detected button release
-        if self.state == [0, 1]:
-            print('button press detected:', self.state, bulbs.get_light(), bulbs.get_night_light())
+        pressed = False
+        # each queued release toggles the light, none are lost while the loop was busy
+        released_at = self.button.get()
+        while released_at is not None:
+            # how long the release waited for the loop to get to it
+            diagnostics.record_since_ms("button", released_at)
+            print('button press detected:', bulbs.get_light(), bulbs.get_night_light())
             bulbs.set_light(not bulbs.get_light())
-            return True
-        return False
+            pressed = True
+            released_at = self.button.get()
+        if pressed:
+            # write the LEDs now rather than at the next refresh
+            bulbs.sync_leds()
+        return pressed
 
 
 def __main():
     button = Button()
     bulbs = BLESmartSwitch()
-    digirm_client = DigiCloud()
-    lasttime = time()
+    outbox = Outbox()
+    digirm_client = DigiCloud(outbox)
     UPDATE_NONE, UPDATE_CLOUD = 0, 1
     update_state = UPDATE_NONE
-    while True:
-        try:
-            if not bulbs.is_connected():
-                bulbs.connect()
-            if button.check_button(bulbs):
-                update_state = UPDATE_CLOUD
-            if bulbs.update_nightlight():
-                update_state = UPDATE_CLOUD
-
-            # Wait until at least 1 second has elapsed before updating
-            if time() - lasttime > 1:
-                lasttime = time()
-                # Update the light and cloud if an update is needed
-                if bulbs.is_connected():
-                    # Refresh the state of the sensors readings
-                    bulbs.update()
-
-                if update_state == UPDATE_CLOUD:
-                    if update_cloud(digirm_client, bulbs):
-                        update_state = UPDATE_NONE
-                if digirm_client.check_update():
-                    bulbs.set_light(digirm_client.get_value() == b'on')
 
-        except OSError as e:
-            # provide debug info, but keep going
-            print_exception(e)
+    def check_state():
+        nonlocal update_state
+        if button.check_button(bulbs):
+            update_state = UPDATE_CLOUD
+        if bulbs.update_nightlight():
+            update_state = UPDATE_CLOUD
+
+    def publish():
+        nonlocal update_state
+        # Update the cloud if an update is needed
+        if update_state == UPDATE_CLOUD:
+            if update_cloud(digirm_client, bulbs, outbox):
+                update_state = UPDATE_NONE
+
+    def sample_telemetry():
+        if bulbs.is_connected():
+            # readings inside the deadband only count towards the window summary
+            if lumens_filter.add(bulbs.get_lumens()):
+                digirm_client.sample(bulbs.get_light(), bulbs.get_night_light(), bulbs.get_lumens())
+            if lumens_filter.due():
+                digirm_client.add_summary(lumens_filter)
+                lumens_filter.clear()
+
+    def light_request(request):
+        body = request.read(8).strip()
+        if body == b"on" or body == b"off":
+            bulbs.set_light(body == b"on")
+            response = "OK"
+        else:
+            response = "ERROR"
+        print("request status: {}".format(response))
+        request.write(response)
+
+    def state_request(request):
+        request.write('{{"light_state":"{}","night_light_state":"{}","lumens":{},"queued":{}}}'.format(
+            digirm_client._get_on_off(bulbs.get_light()), digirm_client._get_on_off(bulbs.get_night_light()),
+            bulbs.get_lumens(), outbox.pending()))
+
+    def config_request(request):
+        # one "task=period_ms" per line, each answered as it is applied
+        for line in digirm_client.router.lines(request):
+            fields = line.decode().split("=", 1)
+            task = scheduler.task(fields[0])
+            if task is None or len(fields) < 2 or not fields[1].isdigit() or int(fields[1]) == 0:
+                request.write("ERROR {}\n".format(line.decode()))
+                continue
+            task.period_ms = int(fields[1])
+            request.write("OK {}={}\n".format(task.name, task.period_ms))
+
+    def history_request(request):
+        # queued readings, written one at a time rather than collected first
+        request.write("seq,time,light_state,night_light_state,lumens\n")
+        records = outbox.records()
+        try:
+            for record in records:
+                request.write("{},{},{},{},{}\n".format(*record))
+        finally:
+            records.close()
+
+    digirm_client.router.default = light_request
+    digirm_client.router.add("light", light_request)
+    digirm_client.router.add("state", state_request)
+    digirm_client.router.add("config", config_request)
+    digirm_client.router.add("history", history_request)
+
+    lumens_filter = DeadbandFilter(absolute=lumens_deadband, relative=lumens_deadband_ratio,
+                                   window_ms=lumens_window_ms)
+
+    def publish_diagnostics():
+        digirm_client.add_diagnostics(diagnostics)
+        diagnostics.clear()
+
+    scheduler = Scheduler(diagnostics, memory)
+    scheduler.add(check_state, periods_ms["state"], name="state")
+    scheduler.add(bulbs.connect, periods_ms["connect"], name="connect")
+    # Refresh the state of the sensors readings
+    scheduler.add(bulbs.update, periods_ms["ble"], periods_ms["ble"] // 2, name="ble")
+    scheduler.add(publish, periods_ms["publish"], name="publish")
+    scheduler.add(lambda: replay_outbox(digirm_client, outbox), periods_ms["replay"], name="replay")
+    scheduler.add(digirm_client.upload, periods_ms["upload"], name="upload")
+    scheduler.add(sample_telemetry, periods_ms["telemetry"], name="telemetry")
+    scheduler.add(digirm_client.check_update, periods_ms["requests"], name="requests")
+    scheduler.add(publish_diagnostics, periods_ms["diagnostics"], name="diagnostics")
+    scheduler.run()
 
 
 __main()